@@ -0,0 +1,77 @@
+class BdfGlyph(object):
+    __slots__ = ('advance', 'pixels')
+
+    def __init__(self, advance, pixels):
+        # pixels are (dx, dy) offsets of the lit pixels from the glyph origin on the baseline
+        self.advance = advance
+        self.pixels = pixels
+
+class BdfFont(object):
+    '''
+    Glyph bitmaps of a BDF font, positioned the way rgbmatrix's graphics.Font draws them, so that glyphs can be
+    rasterized ahead of time.
+    '''
+
+    replacement_codepoint = 0xFFFD
+
+    def __init__(self, font_file):
+        self.height = 0
+        self.baseline = 0
+        self._glyphs = {}
+
+        with open(font_file, 'r', encoding='latin-1') as f:
+            self._load(f)
+
+    def glyph(self, codepoint):
+        '''
+        Returns the glyph of `codepoint`, falling back to the replacement character. None when neither exists.
+        '''
+
+        glyph = self._glyphs.get(codepoint)
+        if glyph is None:
+            glyph = self._glyphs.get(BdfFont.replacement_codepoint)
+        return glyph
+
+    def _load(self, lines):
+        codepoint = None
+        advance = 0
+        bbx = (0, 0, 0, 0)
+        bitmap = None
+
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+
+            keyword = fields[0]
+            if bitmap is not None:
+                if keyword == 'ENDCHAR':
+                    if codepoint is not None and codepoint >= 0:
+                        self._glyphs[codepoint] = BdfGlyph(advance, BdfFont._pixels(bitmap, bbx))
+                    bitmap = None
+                else:
+                    bitmap.append(int(keyword, 16) if keyword else 0)
+            elif keyword == 'FONTBOUNDINGBOX':
+                self.height = int(fields[2])
+                self.baseline = self.height + int(fields[4])
+            elif keyword == 'ENCODING':
+                codepoint = int(fields[1])
+            elif keyword == 'DWIDTH':
+                advance = int(fields[1])
+            elif keyword == 'BBX':
+                bbx = tuple(int(v) for v in fields[1:5])
+            elif keyword == 'BITMAP':
+                bitmap = []
+
+    @staticmethod
+    def _pixels(bitmap, bbx):
+        width,height,x_offset,y_offset = bbx
+        top = -(height + y_offset)
+        pixels = []
+        for row,bits in enumerate(bitmap):
+            # rows are padded to whole bytes, most significant bit first
+            row_bits = ((width + 7) // 8) * 8
+            for column in range(width):
+                if bits & (1 << (row_bits - 1 - column)):
+                    pixels.append((x_offset + column, top + row))
+        return tuple(pixels)
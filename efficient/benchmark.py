@@ -0,0 +1,233 @@
+import argparse
+import json
+import platform
+import random
+import socket
+import time
+from datetime import datetime,timedelta
+from threading import Thread
+
+from display import Display
+from efficient import Efficient
+from tracker import WorkDayTracker
+from tracker_events import *
+
+class RecordingDisplay(Display):
+    '''
+    Headless display that only keeps the last message, so benchmarks measure everything up to the panel.
+    '''
+
+    def __init__(self):
+        self.last_message = None
+        self.writes = 0
+
+    def write(self, message, color=None):
+        self.last_message = message
+        self.writes += 1
+
+    def clear(self):
+        self.last_message = None
+
+class SyntheticWorkday(object):
+    '''
+    Generates a workday of range events: a work range with lunch and mini breaks in between, padded with more breaks
+    until `event_count` is reached. `out_of_order_ratio` of the events are moved to a random later position in the
+    delivery order, the way late clients deliver them.
+    '''
+
+    _range_types = (
+            (WorkStartEvent, WorkEndEvent),
+            (LunchStartEvent, LunchEndEvent),
+            (MiniBreakStartEvent, MiniBreakEndEvent))
+
+    def __init__(self, event_count, out_of_order_ratio=0.0, day=None, seed=0):
+        self._random = random.Random(seed)
+        self._day = day or datetime.utcnow().replace(hour=8, minute=0, second=0, microsecond=0)
+
+        self.events = self._generate(event_count)
+        self.delivery_order = self._shuffle(list(self.events), out_of_order_ratio)
+
+    def tracked(self, tracker):
+        return [e for e in self.delivery_order if isinstance(e, tracker.handled_events())]
+
+    def _generate(self, event_count):
+        span_seconds = 10 * 3600
+        times = sorted(self._random.uniform(0, span_seconds) for _ in range(event_count))
+        events = []
+        for i,offset in enumerate(times):
+            start_type,end_type = SyntheticWorkday._range_types[(i // 2) % len(SyntheticWorkday._range_types)]
+            event_type = start_type if (i % 2 == 0) else end_type
+            time_utc = self._day + timedelta(seconds=offset)
+            events.append(event_type(time_utc, time_utc))
+        return events
+
+    def _shuffle(self, events, out_of_order_ratio):
+        for _ in range(int(len(events) * out_of_order_ratio)):
+            i = self._random.randrange(len(events))
+            j = self._random.randrange(i, len(events))
+            events.insert(j, events.pop(i))
+        return events
+
+class Benchmark(object):
+    def __init__(self, repeat):
+        self._repeat = repeat
+        self.results = {}
+
+    def measure(self, name, operation, operations_per_run=1, setup=None):
+        '''
+        Runs `operation(setup())` `repeat` times and records the per-operation latency percentiles.
+        '''
+
+        samples = []
+        for _ in range(self._repeat):
+            state = setup() if setup else None
+            start = time.perf_counter()
+            operation(state)
+            samples.append((time.perf_counter() - start) / operations_per_run)
+
+        samples.sort()
+        p50 = Benchmark._percentile(samples, 0.50)
+        self.results[name] = {
+            'runs': len(samples),
+            'operations_per_run': operations_per_run,
+            'p50_us': p50 * 1e6,
+            'p99_us': Benchmark._percentile(samples, 0.99) * 1e6,
+            'max_us': samples[-1] * 1e6,
+            'operations_per_second': (1 / p50) if p50 else None,
+        }
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+
+    @staticmethod
+    def _percentile(samples, percentile):
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+def benchmark_tracker(benchmark, workday):
+    tracked = workday.tracked(WorkDayTracker())
+    summarize_at = workday.events[-1].client_time_utc
+
+    def handle(tracker):
+        for e in tracked:
+            tracker.handle(e)
+    benchmark.measure('tracker.handle', handle, len(tracked), setup=WorkDayTracker)
+    benchmark.measure('tracker.handle_many', lambda tracker: tracker.handle_many(tracked), len(tracked), setup=WorkDayTracker)
+
+    def loaded_tracker():
+        tracker = WorkDayTracker()
+        tracker.handle_many(tracked)
+        return tracker
+    tracker = loaded_tracker()
+    benchmark.measure('tracker.summarize', lambda _: tracker.summarize(summarize_at))
+    benchmark.measure('tracker.summarize_aggregate', lambda _: tracker.summarize(summarize_at, aggregate=Efficient._aggregate_range_events))
+    benchmark.measure('efficient.aggregate_range_events', lambda _: Efficient._aggregate_range_events(workday.events))
+
+def benchmark_update(benchmark, workday):
+    tracker = WorkDayTracker()
+    tracker.handle_many(workday.tracked(tracker))
+    display = RecordingDisplay()
+    efficient = Efficient(display, tracker)
+    efficient.start(timedelta(hours=8), None)
+    try:
+        # the runloop ticks too; measure the update directly
+        def update(_):
+            efficient._shown_state = None
+            efficient._update((display, efficient._timer, tracker))
+        benchmark.measure('efficient.update', update)
+        benchmark.measure('efficient.update_unchanged', lambda _: efficient._update((display, efficient._timer, tracker)))
+    finally:
+        efficient.stop()
+
+def benchmark_protocol(benchmark, command_count):
+    try:
+        from binary_protocol import BinaryCommands,BinaryProtocol
+        from command_handler import CommandHandler
+        from network_host import AsyncEfficientServer,EfficientHandler,EfficientServer
+        from sessions import EfficientSessions
+    except ImportError as e:
+        benchmark.skip('protocol', str(e))
+        return
+
+    sessions = EfficientSessions(lambda user_id: Efficient(RecordingDisplay(), WorkDayTracker()))
+    commands = CommandHandler(sessions)
+    event = json.dumps({'command': 'event', 'args': {'name': 'benchmark'}}).encode('utf-8')
+    typed_events = json.dumps({'command': 'events', 'args': {'events': [{'name': 'work_start', 'time': time.time()}]}}).encode('utf-8')
+    frame = BinaryProtocol.pack_request(BinaryCommands.id('event'), body=BinaryProtocol.pack_events([(WorkStartEvent, int(time.time() * 1000))], counted=False))
+
+    benchmark.measure('protocol.handle_message', lambda _: commands.handle_message(event))
+    benchmark.measure('protocol.handle_message_typed_event', lambda _: commands.handle_message(typed_events))
+    benchmark.measure('protocol.handle_frame_typed_event', lambda _: commands.handle_frame(frame))
+
+    server = EfficientServer(('127.0.0.1', 0), EfficientHandler, commands)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        def one_shot(_):
+            for _ in range(command_count):
+                with socket.create_connection(server.server_address) as client:
+                    client.sendall(event)
+                    client.recv(2048)
+        benchmark.measure('protocol.one_shot_connections', one_shot, command_count)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    address = ('127.0.0.1', free_port())
+    async_server = AsyncEfficientServer(address, commands, max_pending=command_count)
+    Thread(target=async_server.serve_forever, daemon=True).start()
+    try:
+        wait_for_port(address)
+        def pipelined(_):
+            with socket.create_connection(address) as client:
+                client.sendall((event + b'\n') * command_count)
+                responses = client.makefile('rb')
+                for _ in range(command_count):
+                    responses.readline()
+        benchmark.measure('protocol.pipelined_connection', pipelined, command_count)
+    finally:
+        async_server.server_close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(address, timeout_seconds=5):
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(address).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.01)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the tracker, aggregation, rendering and protocol hot paths")
+    parser.add_argument("--events", action="store", help="Events in the synthetic workday. Default: 2000", default=2000, type=int)
+    parser.add_argument("--out-of-order", action="store", help="Ratio of events delivered out of order. Default: 0.05", default=0.05, type=float)
+    parser.add_argument("--repeat", action="store", help="Runs per benchmark. Default: 20", default=20, type=int)
+    parser.add_argument("--commands", action="store", help="Commands sent per protocol benchmark run. Default: 200", default=200, type=int)
+    parser.add_argument("--seed", action="store", help="Seed of the synthetic workday. Default: 0", default=0, type=int)
+    parser.add_argument("--skip-protocol", action="store_true", help="Don't run the loopback protocol benchmarks", default=False)
+    parser.add_argument("-o", "--output", action="store", help="File to write the JSON results to. Default: stdout", default=None, type=str)
+    args = parser.parse_args()
+
+    workday = SyntheticWorkday(args.events, args.out_of_order, seed=args.seed)
+    benchmark = Benchmark(args.repeat)
+    benchmark_tracker(benchmark, workday)
+    benchmark_update(benchmark, workday)
+    if not args.skip_protocol:
+        benchmark_protocol(benchmark, args.commands)
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'parameters': vars(args),
+        'results': benchmark.results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
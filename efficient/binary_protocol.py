@@ -0,0 +1,170 @@
+from struct import Struct,error as StructError
+
+from tracker_events import EventTypes
+
+class ResponseCode(object):
+    Ok,Invalid,Unsupported,Malformed,Failed = 0, 1, 2, 3, 4
+
+class BinaryCommands(object):
+    '''
+    Command ids of the binary protocol. Ids are part of the protocol, so new commands must be appended.
+    '''
+
+    _names = ('start', 'pause', 'resume', 'end', 'event', 'events', 'stats')
+    _ids = {name: command for command,name in enumerate(_names, start=1)}
+
+    @staticmethod
+    def id(name):
+        return BinaryCommands._ids[name]
+
+    @staticmethod
+    def name(command):
+        '''
+        Returns the command name of an id, or None when the id is not a command.
+        '''
+        return BinaryCommands._names[command - 1] if 1 <= command <= len(BinaryCommands._names) else None
+
+class BinaryProtocol(object):
+    '''
+    Compact encoding of the command protocol for clients that send events at a high rate.
+    A connection speaks it when its first byte is `magic`, which can't start a JSON command, so JSON clients keep
+    working on the same port. Requests and responses are frames of a fixed header and `length` payload bytes:
+
+        magic (0xEF), version, command id / response code, reserved, request id (echoed back), length
+
+    Request payloads start with the user: a length byte and as many UTF-8 bytes, 0 for the default user. Then:
+      start         seconds (uint32)
+      event         one event: event type code (see EventTypes) and client time in epoch milliseconds (int64)
+      events        count (uint16) and that many events
+      others        nothing
+    Response payloads are the per event EventStatus bytes for 'event' and 'events' (after a count for 'events'),
+    JSON for 'stats', and an UTF-8 message otherwise. The response code carries the outcome.
+    '''
+
+    magic = 0xEF
+    version = 1
+    max_payload = 65535
+
+    header = Struct('<BBBxII')
+    _event = Struct('<Bq')
+    _count = Struct('<H')
+    _duration = Struct('<I')
+    _user_length = Struct('<B')
+
+    @staticmethod
+    def is_binary(data):
+        return bool(data) and (data[0] == BinaryProtocol.magic)
+
+    @staticmethod
+    def payload_length(header):
+        '''
+        Validates a frame header and returns the length of the payload that follows it.
+        '''
+
+        magic,version,_,_,length = BinaryProtocol.header.unpack_from(header)
+        if (magic != BinaryProtocol.magic) or (version != BinaryProtocol.version):
+            raise BinaryProtocolException("Unsupported frame version")
+        if length > BinaryProtocol.max_payload:
+            raise BinaryProtocolException("Frame longer than {0} bytes".format(BinaryProtocol.max_payload))
+        return length
+
+    @staticmethod
+    def pack_request(command, request_id=0, user=None, body=b''):
+        user_bytes = user.encode('utf-8') if user else b''
+        payload = BinaryProtocol._user_length.pack(len(user_bytes)) + user_bytes + body
+        return BinaryProtocol.header.pack(BinaryProtocol.magic, BinaryProtocol.version, command, request_id, len(payload)) + payload
+
+    @staticmethod
+    def unpack_request(frame):
+        '''
+        Returns (command id, request id, user, body) of a complete request frame.
+        '''
+
+        try:
+            length = BinaryProtocol.payload_length(frame)
+            _,_,command,request_id,_ = BinaryProtocol.header.unpack_from(frame)
+            payload = bytes(frame[BinaryProtocol.header.size:BinaryProtocol.header.size + length])
+            if len(payload) != length:
+                raise BinaryProtocolException("Frame shorter than its length")
+
+            user_length, = BinaryProtocol._user_length.unpack_from(payload)
+            user_end = BinaryProtocol._user_length.size + user_length
+            if user_end > len(payload):
+                raise BinaryProtocolException("User longer than the frame")
+            user = payload[BinaryProtocol._user_length.size:user_end].decode('utf-8') if user_length else None
+            return (command, request_id, user, payload[user_end:])
+        except (StructError, UnicodeDecodeError) as e:
+            raise BinaryProtocolException("Malformed frame. {0}".format(e))
+
+    @staticmethod
+    def pack_response(code, request_id, payload=b''):
+        return BinaryProtocol.header.pack(BinaryProtocol.magic, BinaryProtocol.version, code, request_id, len(payload)) + payload
+
+    @staticmethod
+    def unpack_response(frame):
+        '''
+        Returns (response code, request id, payload) of a complete response frame.
+        '''
+
+        length = BinaryProtocol.payload_length(frame)
+        _,_,code,request_id,_ = BinaryProtocol.header.unpack_from(frame)
+        return (code, request_id, bytes(frame[BinaryProtocol.header.size:BinaryProtocol.header.size + length]))
+
+    @staticmethod
+    def pack_duration(seconds):
+        return BinaryProtocol._duration.pack(seconds)
+
+    @staticmethod
+    def unpack_duration(body):
+        try:
+            return BinaryProtocol._duration.unpack(body)[0]
+        except StructError as e:
+            raise BinaryProtocolException("Malformed duration. {0}".format(e))
+
+    @staticmethod
+    def pack_events(events, counted=True):
+        '''
+        Packs (event type, client epoch milliseconds) pairs, with their count for the 'events' command. Events only
+        have a code when they are typed; a None type is sent as code 0, which the server reports as invalid.
+        '''
+
+        records = b''.join(BinaryProtocol._event.pack(EventTypes.code(event_type) if event_type else 0, epoch_ms) for event_type,epoch_ms in events)
+        return (BinaryProtocol._count.pack(len(events)) + records) if counted else records
+
+    @staticmethod
+    def unpack_events(body, counted=True):
+        '''
+        Returns (event type or None for an unknown code, client epoch seconds) pairs.
+        '''
+
+        try:
+            if counted:
+                count, = BinaryProtocol._count.unpack_from(body)
+                body = body[BinaryProtocol._count.size:]
+                if len(body) != count * BinaryProtocol._event.size:
+                    raise BinaryProtocolException("Event count does not match the frame")
+            elif len(body) != BinaryProtocol._event.size:
+                raise BinaryProtocolException("Malformed event")
+            return [(BinaryProtocol._event_type(code), epoch_ms / 1000) for code,epoch_ms in BinaryProtocol._event.iter_unpack(body)]
+        except StructError as e:
+            raise BinaryProtocolException("Malformed events. {0}".format(e))
+
+    @staticmethod
+    def pack_statuses(statuses):
+        return BinaryProtocol._count.pack(len(statuses)) + bytes(statuses)
+
+    @staticmethod
+    def unpack_statuses(payload):
+        count, = BinaryProtocol._count.unpack_from(payload)
+        return list(payload[BinaryProtocol._count.size:BinaryProtocol._count.size + count])
+
+    @staticmethod
+    def _event_type(code):
+        try:
+            return EventTypes.from_code(code) if code > 0 else None
+        except IndexError:
+            return None
+
+class BinaryProtocolException(Exception):
+    def __init__(self, message):
+        self._message = message
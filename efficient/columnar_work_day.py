@@ -0,0 +1,114 @@
+from array import array
+from bisect import bisect_right
+from itertools import islice
+
+from tracker import RangeDurations
+from tracker_events import EpochTimes,EventTypes,RangeEvent
+
+class ColumnarWorkDay(object):
+    '''
+    A day of events stored column-wise: epoch client/server times in `array('d')` and event type codes in `array('B')`.
+    Costs 17 bytes per event instead of an event object and its datetimes, which is what lets months of history stay
+    resident. Event objects are only materialized when `events` is read. The columns are only appended to in place
+    and replaced when events are inserted, so snapshots can share them.
+    Drop-in replacement for WorkDay, e.g. `WorkDayTracker(day_factory=ColumnarWorkDay)`.
+    '''
+
+    def __init__(self):
+        self.durations = RangeDurations()
+        self._client_times = array('d')
+        self._server_times = array('d')
+        self._types = array('B')
+
+    def __len__(self):
+        return len(self._types)
+
+    @property
+    def events(self):
+        return [self._event_at(i) for i in range(len(self._types))]
+
+    def add(self, event):
+        client_time = EpochTimes.to_epoch(event.client_time_utc)
+        if (not self._client_times) or (client_time >= self._client_times[-1]):
+            self._append(event, client_time)
+            self.durations.add(event)
+            return
+
+        index = bisect_right(self._client_times, client_time)
+        self._client_times = self._client_times[:index] + array('d', (client_time,)) + self._client_times[index:]
+        self._server_times = self._server_times[:index] + array('d', (EpochTimes.to_epoch(event.server_time_utc),)) + self._server_times[index:]
+        self._types = self._types[:index] + array('B', (EventTypes.code(type(event)),)) + self._types[index:]
+        if isinstance(event, RangeEvent):
+            range_event = RangeDurations._base_range_event(event.start_event_type)
+            codes = (EventTypes.code(range_event.start_event_type), EventTypes.code(range_event.end_event_type))
+            self.durations.rebuild_range(range_event, (self._event_at(i) for i,code in enumerate(self._types) if code in codes))
+
+    def add_many(self, events):
+        events = sorted(events, key = lambda x: x.client_time_utc)
+        if not events:
+            return
+
+        first_client_time = EpochTimes.to_epoch(events[0].client_time_utc)
+        if (not self._client_times) or (first_client_time >= self._client_times[-1]):
+            for e in events:
+                self._append(e, EpochTimes.to_epoch(e.client_time_utc))
+                self.durations.add(e)
+            return
+
+        # Merging columns is a sort of the combined rows. The sort is stable, so ties keep the existing events first.
+        rows = list(zip(self._client_times, self._server_times, self._types))
+        rows.extend((EpochTimes.to_epoch(e.client_time_utc), EpochTimes.to_epoch(e.server_time_utc), EventTypes.code(type(e))) for e in events)
+        rows.sort(key = lambda x: x[0])
+
+        self._client_times = array('d', (r[0] for r in rows))
+        self._server_times = array('d', (r[1] for r in rows))
+        self._types = array('B', (r[2] for r in rows))
+        self._rebuild_durations()
+
+    def restore(self, events, durations):
+        self._client_times = array('d')
+        self._server_times = array('d')
+        self._types = array('B')
+        for e in events:
+            self._append(e, EpochTimes.to_epoch(e.client_time_utc))
+        self.durations = durations
+
+    def snapshot(self):
+        return ColumnarDaySnapshot(self)
+
+    def _append(self, event, client_time):
+        self._client_times.append(client_time)
+        self._server_times.append(EpochTimes.to_epoch(event.server_time_utc))
+        self._types.append(EventTypes.code(type(event)))
+
+    def _event_at(self, index):
+        event_type = EventTypes.from_code(self._types[index])
+        return event_type(EpochTimes.from_epoch(self._client_times[index]), EpochTimes.from_epoch(self._server_times[index]))
+
+    def _rebuild_durations(self):
+        self.durations = RangeDurations()
+        for i in range(len(self._types)):
+            self.durations.add(self._event_at(i))
+
+class ColumnarDaySnapshot(object):
+    '''
+    Immutable view of a ColumnarWorkDay, see DaySnapshot. It shares the day's columns up to their length when it was
+    taken; events are materialized when `events` is read, the same as for the day.
+    '''
+
+    __slots__ = ('durations', '_client_times', '_server_times', '_types', '_length')
+
+    def __init__(self, day):
+        self.durations = day.durations.copy()
+        self._client_times = day._client_times
+        self._server_times = day._server_times
+        self._types = day._types
+        self._length = len(day._types)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def events(self):
+        return tuple(EventTypes.from_code(code)(EpochTimes.from_epoch(client_time), EpochTimes.from_epoch(server_time))
+                for code,client_time,server_time in islice(zip(self._types, self._client_times, self._server_times), self._length))
@@ -0,0 +1,415 @@
+import json
+
+from datetime import datetime,timedelta
+from math import isfinite
+from time import perf_counter
+
+from binary_protocol import BinaryCommands,BinaryProtocol,BinaryProtocolException,ResponseCode
+from countdown_timer import CountdownTimerException
+from efficient import EfficientException
+from journald_logging import LogManager,Logger
+from metrics import Metrics
+from sessions import EfficientSessions
+from tracker_events import EventTypes
+
+class EventStatus(object):
+    # Per item status returned by the 'events' command. Tracked events are logged too.
+    Tracked,Logged,Invalid = 0, 1, 2
+
+class CommandHandler(object):
+    '''
+    Parses and dispatches the JSON commands of the network protocol to the Efficient session of the command's "user"
+    (the default user when it is not given).
+    It does not know about the transport, so the same commands are served over one-shot and persistent connections.
+    '''
+
+    max_clock_skew = timedelta(days=1)
+    commands = ('start', 'pause', 'resume', 'end', 'event', 'events', 'stats', 'subscribe')
+
+    # Labelled by known commands only, so that clients can't grow the set of metrics
+    _command_seconds = {name: Metrics.histogram('efficient_command_seconds', 'Time to parse and handle a command', command=name) for name in commands + ('unsupported',)}
+    _parse_failures = Metrics.counter('efficient_command_parse_failures_total', 'Messages that could not be parsed as a command')
+    _invalid_event = (EventStatus.Invalid, None, None, None)
+
+    def __init__(self, sessions, track_events=True):
+        '''
+        `track_events` hands typed events straight to the tracker. Turn it off when the tracker is fed from the journal
+        instead (see JournaldEventListener), so that events are not counted twice.
+        '''
+
+        self._sessions = sessions
+        self._track_events = track_events
+
+        self._logger = LogManager.get_logger(__name__)
+
+    def handle_message(self, message):
+        '''
+        Handles one encoded command and returns the response message.
+        '''
+
+        start = perf_counter()
+        self._logger.debug("Handling message '{0}'", message)
+
+        success,command,data = self._parse_command(message)
+        if not success:
+            CommandHandler._parse_failures.inc()
+            self._logger.info("Message parsing failed with '{0}'", data)
+            return data
+
+        response = self._handle_command(command, data)
+
+        label = command if (command in CommandHandler.commands) else 'unsupported'
+        CommandHandler._command_seconds[label].observe(perf_counter() - start)
+        return response
+
+    def handle_frame(self, frame):
+        '''
+        Handles one binary request frame (see BinaryProtocol) and returns the response frame.
+        '''
+
+        start = perf_counter()
+        try:
+            command,request_id,user,body = BinaryProtocol.unpack_request(frame)
+        except BinaryProtocolException as e:
+            CommandHandler._parse_failures.inc()
+            self._logger.info("Frame parsing failed with '{0}'", e)
+            return BinaryProtocol.pack_response(ResponseCode.Malformed, 0, str(e).encode('utf-8'))
+
+        name = BinaryCommands.name(command)
+        self._logger.debug("Handling binary command '{0}'", name)
+        try:
+            code,payload = self._handle_binary_command(name, user, body)
+        except BinaryProtocolException as e:
+            code,payload = ResponseCode.Malformed, str(e).encode('utf-8')
+
+        label = name if name else 'unsupported'
+        CommandHandler._command_seconds[label].observe(perf_counter() - start)
+        return BinaryProtocol.pack_response(code, request_id, payload)
+
+    def _handle_binary_command(self, name, user, body):
+        if name is None:
+            return (ResponseCode.Unsupported, b'Command not supported')
+        if name == 'stats':
+            return (ResponseCode.Ok, self._handle_stats().encode('utf-8'))
+
+        try:
+            efficient = self._sessions.get(user)
+        except EfficientException as e:
+            return (ResponseCode.Invalid, str(e).encode('utf-8'))
+
+        if name in ('event', 'events'):
+            server_time_utc = datetime.utcnow()
+            events = BinaryProtocol.unpack_events(body, counted=(name == 'events'))
+            statuses = self._record_events(efficient, user, (CommandHandler._validate_binary_event(event_type, time, server_time_utc) for event_type,time in events), server_time_utc)
+            if name == 'event':
+                return (ResponseCode.Invalid if statuses[0] == EventStatus.Invalid else ResponseCode.Ok, bytes(statuses))
+            return (ResponseCode.Ok, BinaryProtocol.pack_statuses(statuses))
+
+        try:
+            if name == 'start':
+                seconds = BinaryProtocol.unpack_duration(body)
+                if not seconds:
+                    return (ResponseCode.Invalid, b"Command 'start' needs a duration")
+                efficient.start(timedelta(seconds=seconds), efficient.stop)
+                response = "Timer started for {0} seconds".format(seconds)
+            elif name == 'pause':
+                efficient.pause()
+                response = "Timer paused"
+            elif name == 'resume':
+                efficient.resume()
+                response = "Timer resumed"
+            else:
+                efficient.stop()
+                response = "Timer ended"
+        except (EfficientException, CountdownTimerException) as e:
+            return (ResponseCode.Failed, str(e).encode('utf-8'))
+
+        self._logger.info(response)
+        return (ResponseCode.Ok, response.encode('utf-8'))
+
+    @staticmethod
+    def user_of(message):
+        '''
+        Returns the user a JSON command or a binary request frame is for without handling it, e.g. to run the commands
+        of every user in order. Commands that don't name a user or don't parse are for the default user.
+        '''
+
+        user = None
+        if BinaryProtocol.is_binary(message):
+            try:
+                user = BinaryProtocol.unpack_request(message)[2]
+            except BinaryProtocolException:
+                pass
+        elif b'"user"' in message:
+            try:
+                data = json.loads(message)
+            except ValueError:
+                data = None
+            user = data.get('user') if isinstance(data, dict) else None
+        return user if isinstance(user, str) else EfficientSessions.default_user
+
+    def subscription(self, message):
+        '''
+        Returns (user, response) when `message` is a 'subscribe' command, otherwise None. `user` is None when the
+        subscription is refused and `response` says why. Streaming is up to the transport (see AsyncEfficientServer).
+        '''
+
+        if b'subscribe' not in message:
+            return None
+        success,command,data = self._parse_command(message)
+        if (not success) or (command != 'subscribe'):
+            return None
+
+        user = data.get('user')
+        try:
+            self._sessions.get(user)
+        except EfficientException as e:
+            return (None, str(e))
+
+        user = EfficientSessions.default_user if user is None else user
+        self._logger.info("User '{0}' subscribed", user)
+        return (user, json.dumps({'subscribed': user}, separators=(',', ':')))
+
+    def _handle_command(self, name, data):
+        self._logger.debug("Handling command '{0}'", name)
+        if name == "stats":
+            return self._handle_stats()
+
+        user = data.get('user')
+        try:
+            efficient = self._sessions.get(user)
+        except EfficientException as e:
+            return str(e)
+
+        args = data.get('args')
+        if name == "start":
+            return self._handle_start(efficient, args)
+        elif name == "pause":
+            return self._handle_pause(efficient)
+        elif name == "resume":
+            return self._handle_resume(efficient)
+        elif name == "end":
+            return self._handle_end(efficient)
+        elif name == "event":
+            return self._handle_event(efficient, user, args)
+        elif name == "events":
+            return self._handle_events(efficient, user, args)
+        elif name == "subscribe":
+            return "Command 'subscribe' needs a persistent connection"
+
+        message = "Command '{0}' not supported".format(name) 
+        self._logger.info(message)
+        return message
+
+    def _handle_stats(self):
+        '''
+        Returns the counters and latency histograms of the process as JSON.
+        '''
+
+        return json.dumps(Metrics.snapshot(), separators=(',', ':'))
+
+    def _handle_start(self, efficient, args):
+        '''
+        Wrapper around the start() method of Efficient.
+        Parses the arguments and calls the start() method
+        '''
+
+        if not args or not isinstance(args, dict):
+            message = "Command 'start' does not have any arguments"
+            self._logger.debug(message)
+            return message
+        if 'duration' not in args:
+            message = "Command 'start' does not have any 'duration' specified"
+            self._logger.debug(message)
+            return message
+
+        duration = args['duration']
+        parts = [duration.get(part) for part in ('hours', 'minutes', 'seconds')] if isinstance(duration, dict) else [None]
+        if any(isinstance(part, bool) or not isinstance(part, (int, float)) for part in parts):
+            message = "Command 'start' needs a 'duration' with numeric 'hours', 'minutes' and 'seconds'"
+            self._logger.debug(message)
+            return message
+        hours,minutes,seconds = parts
+
+        try:
+            efficient.start(timedelta(hours=hours, minutes=minutes, seconds=seconds), efficient.stop)
+        except (OverflowError, ValueError):
+            return "Command 'start' has an invalid 'duration'"
+        except (EfficientException, CountdownTimerException) as e:
+            return str(e)
+
+        response = "Timer started for hours:{0} minutes:{1} seconds:{2}".format(hours, minutes, seconds)
+        self._logger.info(response)
+        return response 
+
+    def _handle_pause(self, efficient):
+        '''
+        Wrapper around the pause() method of Efficient.
+        Parses the arguments and calls the pause() method
+        '''
+
+        try:
+            efficient.pause()
+        except (EfficientException, CountdownTimerException) as e:
+            return str(e)
+
+        response = "Timer paused"
+        self._logger.info(response)
+        return response 
+
+    def _handle_resume(self, efficient):
+        '''
+        Wrapper around the resume() method of Efficient.
+        Parses the arguments and calls the resume() method
+        '''
+
+        try:
+            efficient.resume()
+        except (EfficientException, CountdownTimerException) as e:
+            return str(e)
+
+        response = "Timer resumed"
+        self._logger.info(response)
+        return response 
+
+    def _handle_end(self, efficient):
+        '''
+        Wrapper around the stop() method of Efficient.
+        Parses the arguments and calls the stop() method
+        '''
+
+        try:
+            efficient.stop()
+        except (EfficientException, CountdownTimerException) as e:
+            return str(e)
+
+        response = "Timer ended"
+        self._logger.info(response)
+        return response 
+
+    def _handle_event(self, efficient, user, args):
+        if not args or not isinstance(args, dict):
+            message = "Command 'event' does not have any arguments"
+            self._logger.debug(message)
+            return message
+
+        if 'name' not in args:
+            message = "Event does not have any 'name' specified"
+            self._logger.debug(message)
+            return message
+
+        name = args['name']
+        metadata = args['metadata'] if ('metadata' in args) else {}
+        if (not isinstance(name, str)) or (not isinstance(metadata, dict)):
+            message = "Event needs a 'name' string and 'metadata' object"
+            self._logger.debug(message)
+            return message
+        if CommandHandler._has_reserved_fields(metadata):
+            message = "Event metadata can't set the fields {0}".format(', '.join(sorted(Logger.reserved_fields)))
+            self._logger.debug(message)
+            return message
+        # tracked like the other events when the tracker isn't fed from the journal; the command has no client time
+        self._record_events(efficient, user, ((EventStatus.Logged, name, None, metadata),), datetime.utcnow())
+
+        return "Event '{0}' logged".format(name)
+
+    def _handle_events(self, efficient, user, args):
+        '''
+        Logs a batch of events and tracks the typed ones, e.g. events buffered by an offline client.
+        Each item is {"name": ..., "time": <client epoch seconds>, "metadata": {...}}. Items are validated together and
+        the response carries one status per item, in order (see EventStatus).
+        '''
+
+        if not isinstance(args, dict) or not isinstance(args.get('events'), list):
+            message = "Command 'events' does not have any 'events' list specified"
+            self._logger.debug(message)
+            return message
+
+        server_time_utc = datetime.utcnow()
+        statuses = self._record_events(efficient, user, (CommandHandler._validate_event(item, server_time_utc) for item in args['events']), server_time_utc)
+        return json.dumps({'logged': sum(1 for s in statuses if s != EventStatus.Invalid), 'status': statuses}, separators=(',', ':'))
+
+    def _record_events(self, efficient, user, validated_events, server_time_utc):
+        '''
+        Logs the valid ones of (status, name, client time, metadata) events, tracks the typed ones, and returns the
+        status of every event. Events without a client time are tracked at the server time, as they are read back from
+        the journal.
+        '''
+
+        tracked_events = efficient.tracked_events()
+        statuses = []
+        logged = []
+        tracked = []
+        for status,name,client_time_utc,metadata in validated_events:
+            if status == EventStatus.Invalid:
+                statuses.append(status)
+                continue
+
+            logged.append((name, client_time_utc, metadata))
+            event_type = EventTypes.from_name(name)
+            if event_type and issubclass(event_type, tracked_events):
+                tracked.append(event_type(client_time_utc or server_time_utc, server_time_utc))
+                statuses.append(EventStatus.Tracked)
+            else:
+                statuses.append(EventStatus.Logged)
+
+        self._logger.events(logged, user=user)
+        if self._track_events:
+            efficient.track(tracked)
+
+        self._logger.info("Logged {0} of {1} events", len(logged), len(statuses))
+        return statuses
+
+    @staticmethod
+    def _validate_event(item, server_time_utc):
+        if not isinstance(item, dict):
+            return CommandHandler._invalid_event
+
+        name = item.get('name')
+        time = item.get('time')
+        metadata = item.get('metadata', {})
+        if (not isinstance(name, str)) or (not name) or (not isinstance(metadata, dict)):
+            return CommandHandler._invalid_event
+        if CommandHandler._has_reserved_fields(metadata):
+            return CommandHandler._invalid_event
+        if isinstance(time, bool) or (not isinstance(time, (int, float))) or (not isfinite(time)):
+            return CommandHandler._invalid_event
+        return CommandHandler._validate_time(name, time, metadata, server_time_utc)
+
+    @staticmethod
+    def _has_reserved_fields(metadata):
+        # metadata is journaled next to the fields that route and time events, see Logger
+        return any(key.upper() in Logger.reserved_fields for key in metadata)
+
+    @staticmethod
+    def _validate_binary_event(event_type, time, server_time_utc):
+        if event_type is None:
+            return CommandHandler._invalid_event
+        return CommandHandler._validate_time(EventTypes.name(event_type), time, {}, server_time_utc)
+
+    @staticmethod
+    def _validate_time(name, time, metadata, server_time_utc):
+        try:
+            client_time_utc = datetime.utcfromtimestamp(time)
+        except (OverflowError, OSError, ValueError):
+            return CommandHandler._invalid_event
+        if client_time_utc - server_time_utc > CommandHandler.max_clock_skew:
+            return CommandHandler._invalid_event
+
+        return (EventStatus.Logged, name, client_time_utc, metadata)
+
+    def _parse_command(self, message):
+        try:
+            str_message = message.decode('utf-8')
+            data = json.loads(str_message)
+        except UnicodeDecodeError as e:
+            return (False, None, "Message is not UTF-8. {0}".format(str(e)))
+        except json.JSONDecodeError as e:
+            return (False, None, "Malformed Json passed. {0}".format(str(e)))
+
+        if not isinstance(data, dict):
+            return (False, None, "Json not of the correct type. Expected an object")
+        if 'command' not in data:
+            return (False, None, "Json not of the correct type. Missing 'command' type")
+
+        return (True, data['command'], data)
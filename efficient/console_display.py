@@ -1,10 +1,103 @@
-from subprocess import run
+import shutil
+import sys
+
 from display import Display
 
 class ConsoleDisplay(Display):
+    '''
+    Draws on the terminal with ANSI escape sequences. The screen is kept in a buffer of (character, style) cells and
+    only the cells that changed since the last frame are written, so a tick that only changes the seconds costs a
+    few bytes instead of a cleared and redrawn screen.
+    '''
+
+    _blank = (' ', '')
+    _bar_width = 20
+
+    def __init__(self, stream=None, size=None):
+        self._stream = stream or sys.stdout
+        self._size = size
+        self._cells = {}
+        self._cursor = None
+        self._style = None
+        self._started = False
+
     def write(self, message, color=None):
-        self.clear()
-        print(message)
+        style = ConsoleDisplay._color_style(color)
+        self._draw([[(line, style)] for line in message.split('\n')])
+
+    def update(self, state):
+        lines = []
+        if state.overtime:
+            lines.append([('Overtime  ', '1'), ('+' + ConsoleDisplay._format(state.overtime), '1;31')])
+        else:
+            lines.append([('Remaining ', '1'), (ConsoleDisplay._format(state.remaining), '1;32')])
+
+        top = state.event_durations[:3]
+        longest = top[0][1].total_seconds() if top else 0
+        for event,duration in top:
+            name = event.__name__[:-len('Event')] if event.__name__.endswith('Event') else event.__name__
+            filled = int(round(ConsoleDisplay._bar_width * duration.total_seconds() / longest)) if longest else 0
+            lines.append([('{0:<10}'.format(name), ''), (ConsoleDisplay._format(duration), ''), (' ', ''),
+                ('#' * filled, '36'), ('.' * (ConsoleDisplay._bar_width - filled), '2')])
+        self._draw(lines)
 
     def clear(self):
-        run('clear')
\ No newline at end of file
+        self._cells = {}
+        self._cursor = None
+        self._style = None
+        self._started = False
+        self._stream.write('\x1b[0m\x1b[2J\x1b[H\x1b[?25h')
+        self._stream.flush()
+
+    def _draw(self, lines):
+        '''
+        Lays `lines` of (text, style) runs out on cells, truncated to the terminal size, and writes the difference.
+        '''
+
+        columns,rows = self._size or shutil.get_terminal_size()
+        cells = {}
+        for row,runs in enumerate(lines[:rows]):
+            column = 0
+            for text,style in runs:
+                for character in text:
+                    if column >= columns:
+                        break
+                    cells[(row, column)] = (character, style)
+                    column += 1
+
+        out = []
+        if not self._started:
+            # one full clear; every later frame only touches what changed
+            out.append('\x1b[?25l\x1b[0m\x1b[2J')
+            self._started = True
+            self._cursor = None
+            self._style = ''
+
+        changed = sorted(position for position in set(cells) | set(self._cells)
+            if cells.get(position, ConsoleDisplay._blank) != self._cells.get(position, ConsoleDisplay._blank))
+        for position in changed:
+            character,style = cells.get(position, ConsoleDisplay._blank)
+            if position != self._cursor:
+                out.append('\x1b[{0};{1}H'.format(position[0] + 1, position[1] + 1))
+            if style != self._style:
+                out.append('\x1b[0;{0}m'.format(style) if style else '\x1b[0m')
+                self._style = style
+            out.append(character)
+            self._cursor = (position[0], position[1] + 1)
+
+        self._cells = cells
+        if out:
+            self._stream.write(''.join(out))
+            self._stream.flush()
+
+    @staticmethod
+    def _color_style(color):
+        if color is None:
+            return ''
+        return '38;2;{0};{1};{2}'.format(color.R, color.G, color.B)
+
+    @staticmethod
+    def _format(td):
+        hours, remainder = divmod(int(td.total_seconds()), 3600)
+        minutes, seconds = divmod(remainder, 60)
+        return '{:02}:{:02}:{:02}'.format(hours, minutes, seconds)
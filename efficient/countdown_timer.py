@@ -1,23 +1,54 @@
-from datetime import datetime
+import time
 from datetime import timedelta
-from threading import Timer
+
+from timer_scheduler import TimerScheduler
 
 class CountdownTimer(object):
+    '''
+    Counts down a duration on the monotonic clock. Expiry is scheduled on a TimerScheduler shared by all timers, so
+    starting, pausing and resuming timers never creates threads.
+    '''
+
     ZeroDelta = timedelta(0)
-    def __init__(self, duration, on_elapsed):
+    def __init__(self, duration, on_elapsed, scheduler=None):
         self._duration = duration
         self._on_elapsed = on_elapsed
+        self._scheduler = scheduler or TimerScheduler.shared()
 
         self._remaining = self._duration
         self._start_time = None
-        self._end_timer = None
+        self._end_call = None
+        self._elapsed_time = None
+
+    @property
+    def overtime(self):
+        '''
+        Time since the timer ran out, zero while it has not.
+        '''
+
+        if self._elapsed_time is None:
+            return CountdownTimer.ZeroDelta
+        return timedelta(seconds=time.monotonic() - self._elapsed_time)
+
+    @property
+    def phase(self):
+        '''
+        A time.monotonic() time at which the remaining time, or the overtime, is a whole number of seconds, so that
+        sampling the timer a whole number of seconds after it shows each second once. None while it is stopped.
+        '''
+
+        if self._elapsed_time is not None:
+            return self._elapsed_time
+        if not self._is_running():
+            return None
+        return self._start_time + (self._remaining.total_seconds() % 1)
 
     @property
     def remaining(self):
         if not self._is_running():
             return self._remaining
 
-        elapsed = datetime.utcnow() - self._start_time
+        elapsed = timedelta(seconds=time.monotonic() - self._start_time)
         return (self._remaining - elapsed) if (self._remaining > elapsed) else CountdownTimer.ZeroDelta
 
     def start(self):
@@ -26,28 +57,33 @@ class CountdownTimer(object):
         if self._remaining == CountdownTimer.ZeroDelta:
             raise CountdownTimerException("Timer has elapsed")
 
-        self._start_time = datetime.utcnow()
-        self._end_timer = Timer(self._remaining.total_seconds(), self._elapsed)
-        self._end_timer.daemon = True
-        self._end_timer.start()
+        self._start_time = time.monotonic()
+        self._end_call = self._scheduler.schedule(self._remaining.total_seconds(), self._elapsed)
 
     def stop(self):
         if (not self._is_running()) or (self._remaining == CountdownTimer.ZeroDelta):
             return
 
-        elapsed = datetime.utcnow() - self._start_time
+        elapsed = timedelta(seconds=time.monotonic() - self._start_time)
         self._remaining = (self._remaining - elapsed) if (self._remaining > elapsed) else CountdownTimer.ZeroDelta
 
         self._reset_time()
 
     def reset(self):
         self._remaining = self._duration
+        self._elapsed_time = None
         self._reset_time()
 
     def _is_running(self):
         return self._start_time != None
 
     def _elapsed(self):
+        # The timer may have been paused, or paused and resumed, while this call was already due
+        if (not self._is_running()) or (self.remaining > CountdownTimer.ZeroDelta):
+            return
+
+        # when it was due rather than when the call ran, so that the overtime keeps the phase of the countdown
+        self._elapsed_time = self._start_time + self._remaining.total_seconds()
         self._remaining = CountdownTimer.ZeroDelta
         self._reset_time()
 
@@ -56,9 +92,9 @@ class CountdownTimer(object):
 
     def _reset_time(self):
         self._start_time = None
-        if self._end_timer:
-            self._end_timer.cancel()
-        self._end_timer = None
+        if self._end_call:
+            self._scheduler.cancel(self._end_call)
+        self._end_call = None
 
 class CountdownTimerException(Exception):
     def __init__(self, message):
@@ -1,5 +1,10 @@
 from abc import ABC
 from abc import abstractmethod
+from collections import namedtuple
+
+# What an update shows: the remaining time, the time since the timer elapsed, the range durations as
+# (range event type, timedelta) sorted longest first, and the same as the text `message` for text displays.
+DisplayState = namedtuple('DisplayState', ['remaining', 'overtime', 'event_durations', 'message'])
 
 class Display(ABC):
     @abstractmethod
@@ -8,4 +13,41 @@ class Display(ABC):
 
     @abstractmethod
     def clear(self):
-        raise NotImplementedError('abstract type')
\ No newline at end of file
+        raise NotImplementedError('abstract type')
+
+    def update(self, state):
+        '''
+        Shows a DisplayState. Displays that can lay out more than the text message override this.
+        '''
+        self.write(state.message)
+
+class NullDisplay(Display):
+    '''
+    Discards everything written to it, e.g. for sessions that have no display of their own.
+    '''
+
+    def write(self, message, color=None):
+        pass
+
+    def clear(self):
+        pass
+
+class CompositeDisplay(Display):
+    '''
+    Shows the same ticks on several displays, e.g. the LED panel and the console at once.
+    '''
+
+    def __init__(self, displays):
+        self.displays = tuple(displays)
+
+    def write(self, message, color=None):
+        for display in self.displays:
+            display.write(message, color)
+
+    def update(self, state):
+        for display in self.displays:
+            display.update(state)
+
+    def clear(self):
+        for display in self.displays:
+            display.clear()
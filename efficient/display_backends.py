@@ -0,0 +1,46 @@
+import os
+
+class DisplayBackends(object):
+    '''
+    Display backends selectable by name. A backend's module is only imported when the backend is created, so hardware
+    libraries (rgbmatrix) and fonts are never loaded for the other backends.
+    '''
+
+    _font_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'tom-thumb.bdf')
+
+    @staticmethod
+    def names():
+        return ('led', 'led-process', 'console', 'null', 'memory')
+
+    @staticmethod
+    def create(name, options):
+        '''
+        Creates the display backend `name`, or a CompositeDisplay for comma separated names such as 'led,console'.
+        `options` are the parsed command line arguments, see network_host.
+        '''
+
+        if ',' in name:
+            from display import CompositeDisplay
+            return CompositeDisplay(DisplayBackends.create(n.strip(), options) for n in name.split(','))
+
+        if name == 'led':
+            from led_display import LedDisplay
+            return LedDisplay(options)
+        elif name == 'led-process':
+            from render_process import RenderProcessDisplay
+            return RenderProcessDisplay('led', options)
+        elif name == 'console':
+            from console_display import ConsoleDisplay
+            return ConsoleDisplay()
+        elif name == 'null':
+            from display import NullDisplay
+            return NullDisplay()
+        elif name == 'memory':
+            from memory_display import MemoryDisplay
+            return MemoryDisplay(options.led_cols * options.led_chain, options.led_rows * options.led_parallel, DisplayBackends._font_file)
+
+        raise DisplayBackendException("Display backend '{0}' not supported".format(name))
+
+class DisplayBackendException(Exception):
+    def __init__(self, message):
+        self._message = message
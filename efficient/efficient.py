@@ -1,10 +1,14 @@
 from datetime import datetime,timedelta
 from itertools import islice
+from threading import Event as ThreadEvent
 from threading import RLock
 
 from countdown_timer import CountdownTimer
+from display import DisplayState
+from metrics import Metrics
 from runloop import Runloop
-from tracker_events import *
+from timer_scheduler import TimerScheduler
+from tracker import RangeDurations
 
 class Efficient(object):
     '''
@@ -15,13 +19,43 @@ class Efficient(object):
     shown as metrics.
     '''
 
-    def __init__(self, display, tracker):
+    _summarize_seconds = Metrics.histogram('efficient_tracker_summarize_seconds', 'Time to summarize the tracked events on an update')
+    _display_write_seconds = Metrics.histogram('efficient_display_write_seconds', 'Time to write an update to the display')
+    _skipped_updates = Metrics.counter('efficient_skipped_updates_total', 'Updates not written to the display because nothing visible changed')
+
+    # events arriving within this window are shown with one update
+    coalesce_seconds = 0.05
+
+    def __init__(self, display, tracker, runloop_factory=None):
+        '''
+        `runloop_factory` creates the loop that updates the display while a timer runs, e.g. `SharedRunloop.create` to
+        drive many Efficient instances from one thread. Defaults to a Runloop of its own.
+
+        The display is only written when what it shows changed. The runloop only ticks while the timer counts (down, or
+        up after it elapsed), on the timer's phase, right after each of its seconds; it is suspended while the timer is
+        paused. Tracked events,
+        pausing and resuming schedule one update, shared by everything that happens within `coalesce_seconds`, which
+        the runloop runs. The display is only ever written from the runloop thread.
+        '''
+
         self._display = display
         self._tracker = tracker
+        self._runloop_factory = runloop_factory or (lambda: Runloop(delay=timedelta(hours=0, minutes=0, seconds=1)))
 
         self._lock = RLock()
         self._timer = None
         self._runloop = None
+        self._stopped = ThreadEvent()
+        self._stopped.set()
+
+        # held while an update is computed and written, by the runloop and by the coalesced updates
+        self._update_lock = RLock()
+        self._update_call = None
+        self._shown_state = None
+
+    @property
+    def tracker(self):
+        return self._tracker
 
     def start(self, duration, elapsed):
         '''
@@ -33,31 +67,36 @@ class Efficient(object):
 
         with self._lock:
             if not self._timer:
-                self._timer = CountdownTimer(duration, elapsed)
+                self._timer = CountdownTimer(duration, self._on_runloop(elapsed) if elapsed else None)
                 self._timer.start()
+                self._stopped.clear()
 
-                self._runloop = Runloop(delay=timedelta(hours=0, minutes=0, seconds=1))
-                self._runloop.start(action=self._update, action_args=(self._display, self._timer, self._tracker))
+                self._runloop = self._runloop_factory()
+                self._runloop.start(action=self._update, action_args=(self._display, self._timer, self._tracker), phase=self._timer.phase)
+                self._invalidate()
 
     def pause(self):
         '''
         Pauses the timer.
         '''
 
-        self._assert_timer_started()
-
         with self._lock:
+            self._assert_timer_started()
             self._timer.stop()
+            # nothing changes on the display until the next event or resume
+            self._runloop.suspend()
+            self._invalidate()
 
     def resume(self):
         '''
         Resumes a paused timer.
         '''
 
-        self._assert_timer_started()
-
         with self._lock:
+            self._assert_timer_started()
             self._timer.start()
+            self._runloop.start(action=self._update, action_args=(self._display, self._timer, self._tracker), phase=self._timer.phase)
+            self._invalidate()
 
     def stop(self):
         '''
@@ -65,12 +104,49 @@ class Efficient(object):
         '''
 
         with self._lock:
+            # checked under the lock, since a concurrent stop() may have ended the timer already
+            self._assert_timer_started()
             self._runloop.stop()
             self._timer.reset()
-            self._display.clear()
+            if self._update_call:
+                TimerScheduler.shared().cancel(self._update_call)
+                self._update_call = None
+            with self._update_lock:
+                self._display.clear()
+                self._shown_state = None
 
             self._runloop = None
             self._timer = None
+            self._stopped.set()
+
+    def timer_started(self):
+        '''
+        Whether a timer was started and not stopped yet, paused or not.
+        '''
+
+        return self._timer is not None
+
+    def tracked_events(self):
+        '''
+        Event types that can be recorded with track()
+        '''
+
+        return self._tracker.handled_events()
+
+    def track(self, events):
+        '''
+        Records a batch of events with the tracker
+        '''
+
+        self._tracker.handle_many(events)
+        self._invalidate()
+
+    def invalidate(self):
+        '''
+        Schedules an update for state changed elsewhere, e.g. events handed to the tracker directly.
+        '''
+
+        self._invalidate()
 
     def wait_until_stopped(self):
         '''
@@ -79,28 +155,73 @@ class Efficient(object):
 
         self._assert_timer_started()
 
-        self._runloop.wait_until_stopped()
+        self._stopped.wait()
+
+    def _invalidate(self):
+        with self._lock:
+            if self._timer and not self._update_call:
+                self._update_call = TimerScheduler.shared().schedule(Efficient.coalesce_seconds, self._hand_over_update)
+
+    def _hand_over_update(self):
+        # runs on the timer thread shared by all sessions, which must never wait on a display
+        with self._lock:
+            self._update_call = None
+            if self._runloop:
+                self._runloop.call_soon(self._update_invalidated)
+
+    def _on_runloop(self, callback):
+        '''
+        Wraps a timer callback, e.g. stop() when the timer elapses, to run on the runloop instead of the timer thread.
+        '''
+
+        def hand_over():
+            with self._lock:
+                if self._runloop:
+                    self._runloop.call_soon(callback)
+        return hand_over
+
+    def _update_invalidated(self):
+        with self._lock:
+            if not self._timer:
+                return
+            args = (self._display, self._timer, self._tracker)
+        self._update(args)
 
     def _update(self, args):
         '''
-        Called on every cycle of the update loop.
+        Called on every cycle of the update loop, and for invalidated state. Writes to the display only when the state
+        shown, in whole seconds, differs from the one shown last.
         '''
 
-        display = args[0]
-        timer = args[1]
-        tracker = args[2]
+        with self._update_lock:
+            self._update_display(*args)
 
-        hours,minutes,seconds = Efficient._parse(timer.remaining)
+    def _update_display(self, display, timer, tracker):
+        remaining = Efficient._whole_seconds(timer.remaining)
+        overtime = Efficient._whole_seconds(timer.overtime)
+        hours,minutes,seconds = Efficient._parse(remaining)
         message = '{:02}:{:02}:{:02}'.format(hours, minutes, seconds)
-
-        event_durations = tracker.summarize(datetime.now(), aggregate=Efficient._aggregate_range_events)
-        event_durations = Efficient._pretty_format(event_durations)
-        top_2_event_durations = islice(sorted(event_durations, key=lambda x: x[1], reverse=True), 2)
+        if overtime:
+            hours,minutes,seconds = Efficient._parse(overtime)
+            message = '+{:02}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+        with Efficient._summarize_seconds.time():
+            event_durations = tracker.summarize(datetime.now())
+        event_durations = {event: Efficient._whole_seconds(duration) for event,duration in event_durations.items()}
+        pretty_event_durations = Efficient._pretty_format(event_durations)
+        top_2_event_durations = islice(sorted(pretty_event_durations, key=lambda x: x[1], reverse=True), 2)
         for event_duration in top_2_event_durations:
             ev,du = event_duration
             message += '\n{0} {1:02}'.format(ev, du)
 
-        display.write(message)
+        state = DisplayState(remaining, overtime, sorted(event_durations.items(), key=lambda x: x[1], reverse=True), message)
+        if state == self._shown_state:
+            Efficient._skipped_updates.inc()
+            return
+
+        self._shown_state = state
+        with Efficient._display_write_seconds.time():
+            display.update(state)
 
     @staticmethod
     def _aggregate_range_events(events):
@@ -108,39 +229,19 @@ class Efficient(object):
         Aggregates events to show the top N events that took the most time.
         It computes the duration between a start and end event. If the end event is not found then assume it is an ongoing event
         and compute duration.
+        Trackers keep these durations up to date as events arrive; this is for aggregating an arbitrary list of events.
         '''
 
-        range_events = (event for event in events if isinstance(event, RangeEvent))
-        start_events = {}
-        event_durations = {}
-
-        for event in range_events:
-            if isinstance(event, event.start_event_type):
-                start_events[event.start_event_type] = event
-            if start_events.get(event.start_event_type) and isinstance(event, event.end_event_type):
-                range_event = Efficient._base_range_event(event.end_event_type)
-                end_event = event
-                duration = event_durations.get(range_event) if event_durations.get(range_event) else timedelta()
-                duration += end_event.client_time_utc - start_events[event.start_event_type].client_time_utc
-                event_durations[range_event] = duration
-                del(start_events[event.start_event_type])
+        durations = RangeDurations()
+        for event in events:
+            durations.add(event)
         # If start event does not have an end event compute duration with datetime.utcnow() as it might an ongoing event
-        for start_event in start_events:
-            range_event = Efficient._base_range_event(start_event)
-            duration = event_durations.get(range_event) if event_durations.get(range_event) else timedelta()
-            duration += datetime.utcnow() - start_events[start_event].client_time_utc
-            event_durations[range_event] = duration
-
-        return event_durations
+        return durations.at(datetime.utcnow())
 
     def _assert_timer_started(self):
         if not self._timer:
             raise EfficientException("Timer not started")
 
-    @staticmethod
-    def _base_range_event(event):
-        return event.__bases__[0]
-
     @staticmethod
     def _pretty_format(event_durations):
         # send it back as a iterable of kv pairs.
@@ -149,6 +250,10 @@ class Efficient(object):
             duration = d or h or m or s
             yield (event.__name__[:2], duration)
 
+    @staticmethod
+    def _whole_seconds(td):
+        return timedelta(seconds=int(td.total_seconds()))
+
     @staticmethod
     def _days_hours_minutes_seconds(td):
         return td.days, td.seconds//3600, (td.seconds//60)%60, (td.seconds)%60
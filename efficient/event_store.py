@@ -0,0 +1,347 @@
+import mmap
+import os
+from datetime import timedelta
+from struct import Struct
+from threading import RLock
+
+from tracker import RangeDurations,Tracker
+from tracker_events import EpochTimes,EventTypes
+
+class EventStore(object):
+    '''
+    Local, append-only persistence for tracker events that does not depend on journald.
+
+    Events are appended to `events.<generation>.log` as fixed-size binary records. A snapshot compacts everything
+    recorded so far into one `snapshot.<day>.<generation>` file per day, with the sorted events of the day and their
+    range durations, so loading a day needs no sorting and no range pairing. Only the days that changed since the
+    last snapshot are written; `snapshot` lists the current file of every day and is replaced last, so a snapshot
+    cut short by a crash leaves the previous one whole. Taking a snapshot starts the next log generation and
+    removes the older logs. Loading memory-maps the day files and replays the logs from the snapshot's generation
+    onwards, which is the only part that costs per-event work.
+    '''
+
+    # type code, client epoch, server epoch
+    _record = Struct('<B7xdd')
+    # magic, version, generation, day count
+    _snapshot_header = Struct('<4sHIxxI')
+    _snapshot_magic = b'EFSN'
+    _snapshot_version = 2
+    # day ordinal, generation of the day's file
+    _snapshot_day = Struct('<II')
+    # event count, closed range count, open range count
+    _day_header = Struct('<IBB2x')
+    # start event type code of the range, seconds
+    _closed_range = Struct('<B7xd')
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = RLock()
+        self._generation = 0
+        self._log = None
+        # day ordinal -> generation of the day's snapshot file
+        self._days = {}
+
+        os.makedirs(self._directory, exist_ok=True)
+
+    def load(self, tracker):
+        '''
+        Restores `tracker` from the last snapshot and the log tail, and opens the log for appending.
+        '''
+
+        with self._lock:
+            self._generation = self._load_snapshot(tracker)
+
+            tail = []
+            for generation in self._log_generations():
+                if generation >= self._generation:
+                    tail.extend(self._read_log(generation))
+                    self._generation = generation
+            tracker.handle_many(tail)
+
+            self._open_log()
+
+    def append(self, events):
+        with self._lock:
+            if not self._log:
+                self._open_log()
+
+            self._log.write(b''.join(EventStore._pack(e) for e in events))
+            self._log.flush()
+
+    def snapshot(self, tracker):
+        '''
+        Compacts the days of `tracker` that changed since its last snapshot into a new snapshot, see
+        `WorkDayTracker.changed_days()`. Appends must go through the same lock as the tracker updates (see
+        PersistentTracker), otherwise events could be missed by both the snapshot and the new log.
+        '''
+
+        with self._lock:
+            previous_generation = self._generation
+            self._generation += 1
+            self._open_log()
+
+            superseded = []
+            for key,day in tracker.changed_days().items():
+                with open(self._day_path(key, self._generation), 'wb') as f:
+                    EventStore._write_day(f, day)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if key in self._days:
+                    superseded.append(self._day_path(key, self._days[key]))
+                self._days[key] = self._generation
+
+            snapshot_file = self._path('snapshot')
+            temp_file = snapshot_file + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(EventStore._snapshot_header.pack(EventStore._snapshot_magic, EventStore._snapshot_version, self._generation, len(self._days)))
+                f.write(b''.join(EventStore._snapshot_day.pack(key, generation) for key,generation in sorted(self._days.items())))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, snapshot_file)
+
+            for path in superseded:
+                os.remove(path)
+            for generation in self._log_generations():
+                if generation <= previous_generation:
+                    os.remove(self._log_path(generation))
+
+    def close(self):
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    def _open_log(self):
+        if self._log:
+            self._log.close()
+        self._log = open(self._log_path(self._generation), 'ab')
+        # drop a record torn by a crash, so that the records appended after it stay aligned
+        torn = self._log.tell() % EventStore._record.size
+        if torn:
+            self._log.truncate(self._log.tell() - torn)
+            self._log.seek(0, os.SEEK_END)
+
+    def _load_snapshot(self, tracker):
+        generation = 0
+        days = {}
+        with EventStore._map(self._path('snapshot')) as data:
+            if data:
+                magic,version,generation,day_count = EventStore._snapshot_header.unpack_from(data, 0)
+                if (magic != EventStore._snapshot_magic) or (version != EventStore._snapshot_version):
+                    raise EventStoreException("Unsupported snapshot '{0}'".format(self._path('snapshot')))
+
+                start = EventStore._snapshot_header.size
+                days = dict(EventStore._snapshot_day.iter_unpack(data[start:start + (day_count * EventStore._snapshot_day.size)]))
+
+        for key,day_generation in days.items():
+            with EventStore._map(self._day_path(key, day_generation)) as data:
+                if not data:
+                    raise EventStoreException("Missing snapshot day '{0}'".format(self._day_path(key, day_generation)))
+                EventStore._read_day(data, 0, tracker)
+        self._days = days
+        self._remove_unlisted_days()
+        return generation
+
+    @staticmethod
+    def _write_day(f, day):
+        events = day.events
+        closed_durations = day.durations.closed_durations
+        open_events = day.durations.open_events
+
+        f.write(EventStore._day_header.pack(len(events), len(closed_durations), len(open_events)))
+        for range_event,duration in closed_durations.items():
+            f.write(EventStore._closed_range.pack(EventTypes.code(range_event.start_event_type), duration.total_seconds()))
+        for event in open_events:
+            f.write(EventStore._pack(event))
+        f.write(b''.join(EventStore._pack(e) for e in events))
+
+    @staticmethod
+    def _read_day(data, offset, tracker):
+        events,durations,offset = EventStore._unpack_day(data, offset)
+        tracker.restore_day(events, durations)
+        return offset
+
+    @staticmethod
+    def _unpack_day(data, offset):
+        event_count,closed_count,open_count = EventStore._day_header.unpack_from(data, offset)
+        offset += EventStore._day_header.size
+
+        closed_durations = {}
+        for _ in range(closed_count):
+            code,seconds = EventStore._closed_range.unpack_from(data, offset)
+            closed_durations[EventTypes.from_code(code).__bases__[0]] = timedelta(seconds=seconds)
+            offset += EventStore._closed_range.size
+
+        end = offset + (open_count * EventStore._record.size)
+        open_events = EventStore._unpack_all(data[offset:end])
+        offset = end
+
+        end = offset + (event_count * EventStore._record.size)
+        events = EventStore._unpack_all(data[offset:end])
+        offset = end
+
+        return (events, RangeDurations(closed_durations, open_events), offset)
+
+    def _read_log(self, generation):
+        with EventStore._map(self._log_path(generation)) as data:
+            if not data:
+                return []
+            usable = len(data) - (len(data) % EventStore._record.size)
+            return EventStore._unpack_all(data[:usable])
+
+    def _log_generations(self):
+        generations = []
+        for name in os.listdir(self._directory):
+            parts = name.split('.')
+            if (len(parts) == 3) and (parts[0] == 'events') and (parts[2] == 'log') and parts[1].isdigit():
+                generations.append(int(parts[1]))
+        return sorted(generations)
+
+    def _remove_unlisted_days(self):
+        # left by a snapshot cut short before it replaced `snapshot`
+        listed = {os.path.basename(self._day_path(key, generation)) for key,generation in self._days.items()}
+        for name in os.listdir(self._directory):
+            if name.startswith('snapshot.') and (name != 'snapshot.tmp') and (name not in listed):
+                os.remove(self._path(name))
+
+    def _day_path(self, key, generation):
+        return self._path('snapshot.{0}.{1}'.format(key, generation))
+
+    def _log_path(self, generation):
+        return self._path('events.{0}.log'.format(generation))
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    @staticmethod
+    def _map(path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return _EmptyMap()
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return _EmptyMap()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _pack(event):
+        return EventStore._record.pack(EventTypes.code(type(event)), EpochTimes.to_epoch(event.client_time_utc), EpochTimes.to_epoch(event.server_time_utc))
+
+    @staticmethod
+    def _unpack_all(data):
+        return [EventTypes.from_code(code)(EpochTimes.from_epoch(client_time), EpochTimes.from_epoch(server_time))
+                for code,client_time,server_time in EventStore._record.iter_unpack(data)]
+
+class _EmptyMap(object):
+    def __enter__(self):
+        return b''
+
+    def __exit__(self, *args):
+        return False
+
+class DayStore(object):
+    '''
+    Days evicted from a WorkDayTracker's memory, one `day.<ordinal>` file per day in the snapshot's day encoding.
+    It is a cache that only lives as long as the tracker using it, so files left by a previous run are removed;
+    persistence is up to the EventStore.
+    '''
+
+    def __init__(self, directory):
+        self._directory = directory
+
+        os.makedirs(self._directory, exist_ok=True)
+        for name in os.listdir(self._directory):
+            if name.startswith('day.'):
+                os.remove(os.path.join(self._directory, name))
+
+    def save(self, key, day):
+        day_file = self._path(key)
+        temp_file = day_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            EventStore._write_day(f, day)
+        os.replace(temp_file, day_file)
+
+    def load(self, key):
+        '''
+        Returns the sorted events and the range durations of a saved day, or None when it was not saved.
+        '''
+
+        with EventStore._map(self._path(key)) as data:
+            if not data:
+                return None
+            events,durations,_ = EventStore._unpack_day(data, 0)
+            return (events, durations)
+
+    def _path(self, key):
+        return os.path.join(self._directory, 'day.{0}'.format(key))
+
+class PersistentTracker(Tracker):
+    '''
+    Wraps a tracker so that every handled event is appended to an EventStore before it is tracked, and snapshots the
+    days of the wrapped tracker that changed every `snapshot_every` events, so a snapshot costs those days rather
+    than the whole history.
+    '''
+
+    def __init__(self, tracker, store, snapshot_every=4096):
+        self._tracker = tracker
+        self._store = store
+        self._snapshot_every = snapshot_every
+
+        self._lock = RLock()
+        self._since_snapshot = 0
+
+    def load(self):
+        with self._lock:
+            self._store.load(self._tracker)
+
+    def handled_events(self):
+        return self._tracker.handled_events()
+
+    def handle(self, event):
+        self.handle_many((event,))
+
+    def handle_many(self, events):
+        events = list(events)
+        if not events:
+            return
+
+        with self._lock:
+            self._store.append(events)
+            self._tracker.handle_many(events)
+
+            self._since_snapshot += len(events)
+            if self._since_snapshot >= self._snapshot_every:
+                self.snapshot()
+
+    def snapshot(self):
+        with self._lock:
+            self._store.snapshot(self._tracker)
+            self._since_snapshot = 0
+
+    def close(self):
+        '''
+        Snapshots the tracker and closes the store, e.g. when its session is evicted.
+        '''
+
+        with self._lock:
+            self.snapshot()
+            self._store.close()
+
+    def summarize(self, dt, aggregate=None):
+        return self._tracker.summarize(dt, aggregate)
+
+    def summarize_range(self, start, end):
+        return self._tracker.summarize_range(start, end)
+
+    def days(self):
+        return self._tracker.days()
+
+    def restore_day(self, events, durations):
+        # restored days come from a store already, so they are not appended again
+        with self._lock:
+            self._tracker.restore_day(events, durations)
+
+class EventStoreException(Exception):
+    def __init__(self, message):
+        self._message = message
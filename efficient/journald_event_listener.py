@@ -2,3 +2,174 @@
 # Listens for events from the log source
 # Creates typed events
 # Auto generates events for AutoExpiringEvents
+
+import os
+from datetime import datetime
+from threading import Event as ThreadEvent
+from threading import Thread
+
+from systemd import journal
+
+from journald_logging import LogManager
+from tracker_events import EpochTimes,EventTypes
+
+class JournaldEventListener(object):
+    '''
+    Streams the events recorded by `Logger.event(s)` from the journal into a tracker.
+    Only entries of the given logger whose EVENT_NAME is an event handled by the tracker are read; the filtering is done
+    by journald matches. Events are handed to the tracker in batches, and after every batch the journal cursor is saved
+    so that a restart resumes right after the last handled entry. Without a saved cursor the stream starts at `since`
+    (a UTC datetime), which journald seeks to through its time index rather than by reading the history before it.
+    With `tracker_for_user`, events are routed by their USER field to `tracker_for_user(user)`; events without one go
+    to `tracker`, and the events of a user `tracker_for_user` fails for are skipped. `on_handled(user)` is called after
+    a batch of a user's events was handled (user None for `tracker`).
+    '''
+
+    def __init__(self, tracker, logger_name, cursor_file=None, since=None, batch_size=256, wait_seconds=1, tracker_for_user=None, on_handled=None):
+        self._tracker = tracker
+        self._tracker_for_user = tracker_for_user
+        self._on_handled = on_handled
+        self._logger_name = logger_name
+        self._cursor_file = cursor_file
+        self._since = since
+        self._batch_size = batch_size
+        self._wait_seconds = wait_seconds
+
+        self._listener = None
+        self._terminate = ThreadEvent()
+        self._logger = LogManager.get_logger(__name__)
+
+    def start(self):
+        if self._listener:
+            return
+
+        self._listener = Thread(name='journald_event_listener', target=self._run)
+        self._listener.daemon = True
+        self._listener.start()
+
+    def stop(self):
+        if not self._listener:
+            return
+
+        self._terminate.set()
+        self._listener.join(self._wait_seconds * 2)
+
+        self._listener = None
+        self._terminate.clear()
+
+    def _run(self):
+        reader = journal.Reader(converters={'__REALTIME_TIMESTAMP': JournaldEventListener._realtime_to_utc})
+        try:
+            self._add_matches(reader)
+            self._seek(reader)
+
+            while not self._terminate.is_set():
+                self._read_available(reader)
+                reader.wait(self._wait_seconds)
+        finally:
+            reader.close()
+
+    def _add_matches(self, reader):
+        # Matches on the same field are OR'ed and matches on different fields are AND'ed
+        reader.add_match(LOGGER=self._logger_name)
+        for event_type in self._tracker.handled_events():
+            reader.add_match(EVENT_NAME=EventTypes.name(event_type))
+
+    def _seek(self, reader):
+        cursor = self._load_cursor()
+        if cursor:
+            self._logger.info("Resuming journal from cursor '{0}'", cursor)
+            reader.seek_cursor(cursor)
+            # seek_cursor positions on the already handled entry
+            reader.get_next()
+        elif self._since:
+            self._logger.info("Reading journal since '{0}'", self._since)
+            reader.seek_realtime(EpochTimes.to_epoch(self._since))
+        else:
+            reader.seek_tail()
+            reader.get_previous()
+
+    def _read_available(self, reader):
+        batch = []
+        cursor = None
+        for entry in reader:
+            if self._terminate.is_set():
+                break
+
+            cursor = entry['__CURSOR']
+            event = JournaldEventListener._to_event(entry)
+            if event:
+                batch.append((entry.get('USER'), event))
+            if len(batch) >= self._batch_size:
+                self._flush(batch, cursor)
+                batch = []
+                cursor = None
+
+        if cursor:
+            self._flush(batch, cursor)
+
+    def _flush(self, batch, cursor):
+        users = {}
+        for user,event in batch:
+            users.setdefault(user, []).append(event)
+        for user,events in users.items():
+            tracker = self._tracker_of(user)
+            if tracker is None:
+                continue
+            tracker.handle_many(events)
+            if self._on_handled:
+                try:
+                    self._on_handled(user)
+                except Exception as e:
+                    self._logger.error("Handled events of user '{0}' not announced. {1}", user, e)
+
+        self._save_cursor(cursor)
+
+    def _tracker_of(self, user):
+        if user and self._tracker_for_user:
+            try:
+                return self._tracker_for_user(user)
+            except Exception as e:
+                # e.g. too many sessions; the user's events must not be counted for another user
+                self._logger.error("Skipping the events of user '{0}' without a tracker. {1}", user, e)
+                return None
+        return self._tracker
+
+    def _load_cursor(self):
+        if not self._cursor_file:
+            return None
+        try:
+            with open(self._cursor_file, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _save_cursor(self, cursor):
+        if not self._cursor_file:
+            return
+
+        # write and rename so that a crash never leaves a torn cursor behind
+        temp_file = self._cursor_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(cursor)
+        os.replace(temp_file, self._cursor_file)
+
+    @staticmethod
+    def _to_event(entry):
+        event_type = EventTypes.from_name(entry.get('EVENT_NAME'))
+        if not event_type:
+            return None
+
+        server_time_utc = entry['__REALTIME_TIMESTAMP']
+        client_time_utc = server_time_utc
+        if 'CLIENT_TIME_UTC' in entry:
+            try:
+                client_time_utc = datetime.fromisoformat(entry['CLIENT_TIME_UTC'])
+            except ValueError:
+                pass
+
+        return event_type(client_time_utc, server_time_utc)
+
+    @staticmethod
+    def _realtime_to_utc(value):
+        return datetime.utcfromtimestamp(int(value) / 1000000)
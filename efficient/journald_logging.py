@@ -1,30 +1,188 @@
-from systemd import journal
+from queue import Empty,Full,Queue
+from threading import Thread
+
+from syslog import LOG_DEBUG,LOG_ERR,LOG_INFO
+
+from metrics import Metrics
+
+try:
+    from systemd import journal
+except ImportError:
+    # off the device, e.g. with the console or memory displays; records are dropped when sent
+    journal = None
 
 class LogManager(object):
+    '''
+    Creates loggers and holds the logging configuration of the process.
+    Messages below `level` are dropped before they are formatted. With a background writer, records are queued and
+    formatted and sent to journald in batches on the writer's thread, so a slow journald never delays the caller.
+    '''
+
+    level = LOG_DEBUG
+    _writer = None
+
     @staticmethod
     def get_logger(name):
         return Logger(name)
 
+    @staticmethod
+    def set_level(level):
+        LogManager.level = level
+
+    @staticmethod
+    def start_background(queue_size=4096, batch_size=64, block=False):
+        '''
+        Starts the background writer. When the queue is full, log messages are dropped unless `block` is set, in which
+        case the caller waits for room. Events are never dropped.
+        '''
+
+        if LogManager._writer:
+            return
+        LogManager._writer = _JournalWriter(queue_size, batch_size, block)
+        LogManager._writer.start()
+
+    @staticmethod
+    def stop_background():
+        '''
+        Sends what is queued and goes back to sending synchronously.
+        '''
+
+        writer = LogManager._writer
+        LogManager._writer = None
+        if writer:
+            writer.stop()
+
+    @staticmethod
+    def _submit(record, droppable=True):
+        writer = LogManager._writer
+        if writer:
+            writer.submit(record, droppable)
+        else:
+            record.send()
+
 class Logger(object):
+    '''
+    Messages are `str.format` templates formatted with `args` only when the record is sent,
+    e.g. `logger.debug("Handling command '{0}'", name)`.
+    Event metadata shares the journal fields with the fields that route and time events (see JournaldEventListener),
+    so metadata keys that uppercase to one of `reserved_fields` are never written.
+    '''
+
+    reserved_fields = frozenset(('MESSAGE', 'PRIORITY', 'LOGGER', 'EVENT_NAME', 'CLIENT_TIME_UTC', 'USER'))
+
     def __init__(self, name):
         self._name = name
 
-    def debug(self, message):
-        journal.send(message, PRIORITY=journal.LOG_DEBUG, LOGGER=self._name)
+    def debug(self, message, *args):
+        if LogManager.level >= LOG_DEBUG:
+            LogManager._submit(_Record(LOG_DEBUG, self._name, message, args))
+
+    def info(self, message, *args):
+        if LogManager.level >= LOG_INFO:
+            LogManager._submit(_Record(LOG_INFO, self._name, message, args))
 
-    def info(self, message):
-        journal.send(message, PRIORITY=journal.LOG_INFO, LOGGER=self._name)
+    def error(self, message, *args):
+        if LogManager.level >= LOG_ERR:
+            LogManager._submit(_Record(LOG_ERR, self._name, message, args))
 
-    def error(self, message):
-        journal.send(message, PRIORITY=journal.LOG_ERR, LOGGER=self._name)
+    def event(self, name, metadata, user=None):
+        LogManager._submit(_EventRecord(self._name, name, None, metadata, user), droppable=False)
 
-    def event(self, name, metadata):
-        message = "Recording event '{0}'".format(name) #just not required but lazy to deal with `sendv` api
-        journal.send(message, PRIORITY=journal.LOG_INFO, LOGGER=self._name, EVENT_NAME=name, **(Logger._format_metadata(metadata)))
+    def events(self, events, user=None):
+        '''
+        Records a batch of (name, client_time_utc, metadata) events in one pass.
+        '''
+        for name,client_time_utc,metadata in events:
+            LogManager._submit(_EventRecord(self._name, name, client_time_utc, metadata, user), droppable=False)
 
     @staticmethod
-    def _format_metadata(metadata):
+    def _format_metadata(metadata, user=None):
         """
             Convert keys in kwargs to uppercase. This is journald style guide
         """
-        return {key.upper(): str(value) for key,value in metadata.items()}
+        fields = {key.upper(): str(value) for key,value in metadata.items() if key.upper() not in Logger.reserved_fields}
+        if user:
+            fields['USER'] = user
+        return fields
+
+class _Record(object):
+    __slots__ = ('priority', 'logger', 'message', 'args')
+
+    def __init__(self, priority, logger, message, args):
+        self.priority = priority
+        self.logger = logger
+        self.message = message
+        self.args = args
+
+    def send(self):
+        if not journal:
+            return
+        message = self.message.format(*self.args) if self.args else self.message
+        journal.send(message, PRIORITY=self.priority, LOGGER=self.logger)
+
+class _EventRecord(object):
+    __slots__ = ('logger', 'name', 'client_time_utc', 'metadata', 'user')
+
+    def __init__(self, logger, name, client_time_utc, metadata, user):
+        self.logger = logger
+        self.name = name
+        self.client_time_utc = client_time_utc
+        self.metadata = metadata
+        self.user = user
+
+    def send(self):
+        if not journal:
+            return
+        message = "Recording event '{0}'".format(self.name) #just not required but lazy to deal with `sendv` api
+        fields = Logger._format_metadata(self.metadata, self.user)
+        if self.client_time_utc:
+            fields['CLIENT_TIME_UTC'] = self.client_time_utc.isoformat()
+        journal.send(message, PRIORITY=LOG_INFO, LOGGER=self.logger, EVENT_NAME=self.name, **fields)
+
+class _JournalWriter(object):
+    _dropped = Metrics.counter('efficient_log_dropped_total', 'Log messages dropped because the log queue was full')
+    _sent = Metrics.counter('efficient_log_sent_total', 'Log records sent to journald by the background writer')
+
+    def __init__(self, queue_size, batch_size, block):
+        self._queue = Queue(maxsize=queue_size)
+        self._batch_size = batch_size
+        self._block = block
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(name='journal_writer', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, record, droppable):
+        if self._block or not droppable:
+            self._queue.put(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            _JournalWriter._dropped.inc()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self._batch_size:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+
+            for record in batch:
+                if record is None:
+                    return
+                try:
+                    record.send()
+                except Exception:
+                    # nowhere to report a failing journal; keep the writer alive for the next records
+                    pass
+            _JournalWriter._sent.inc(len(batch))
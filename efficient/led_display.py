@@ -1,7 +1,10 @@
+import os
 from collections import namedtuple
+from collections import OrderedDict
 from journald_logging import LogManager
 from rgbmatrix import RGBMatrix, RGBMatrixOptions, graphics
 
+from bdf_font import BdfFont
 from color import Color
 from display import Display
 
@@ -9,17 +12,48 @@ class LedFont(graphics.Font):
     def __init__(self, font_file):
         super().__init__()
         super().LoadFont(font_file)
+        self.bitmaps = BdfFont(font_file)
+
+class GlyphCache(object):
+    '''
+    Pre-rasterized glyphs keyed by (font, char, color): the advance and the lit pixels with their color, ready for SetPixel.
+    '''
+
+    def __init__(self):
+        self._glyphs = {}
+
+    def get(self, font, char, color):
+        key = (font, char, color.R, color.G, color.B)
+        glyph = self._glyphs.get(key)
+        if glyph is None:
+            glyph = GlyphCache._rasterize(font, char, color)
+            self._glyphs[key] = glyph
+        return glyph
+
+    @staticmethod
+    def _rasterize(font, char, color):
+        bitmap = font.bitmaps.glyph(ord(char))
+        if bitmap is None:
+            return (0, ())
+        return (bitmap.advance, tuple((dx, dy, color.R, color.G, color.B) for dx,dy in bitmap.pixels))
 
 class LedColor:
     Red,Green,Blue = Color(255, 0, 0), Color(0, 255, 0), Color(0, 0, 255)
 
 class LedDisplay(Display):
-    defaultFont = LedFont("fonts/tom-thumb.bdf") 
+    '''
+    Writes text to the LED matrix. Frames are diffed per character cell: only the cells that changed since the frame
+    currently on the offscreen canvas are erased and redrawn, and a frame identical to the one shown is not swapped at all.
+    '''
+
+    defaultFontFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'tom-thumb.bdf')
     defaultColor = LedColor.Green
+    max_cached_lines = 256
+    _defaultFont = None
 
-    def __init__(self, options, font=defaultFont):
+    def __init__(self, options, font=None):
         self._logger = LogManager.get_logger(__name__)
-        self._logger.debug("Initializing display with '{0}'".format(options))
+        self._logger.debug("Initializing display with '{0}'", options)
 
         matrix_options = RGBMatrixOptions()
 
@@ -41,24 +75,83 @@ class LedDisplay(Display):
         self._matrix = RGBMatrix(options = matrix_options)
         self._offscreen_canvas = self._matrix.CreateFrameCanvas()
 
-        self._font = font
+        self._font = font or LedDisplay.default_font()
 
-    def write(self, message, color=defaultColor):
-        self._offscreen_canvas.Clear()
+        self._glyphs = GlyphCache()
+        self._lines = OrderedDict()
+        # Cells on each of the two canvases, as {(x, baseline): glyph}. None when the canvas content is unknown.
+        self._displayed_frame = None
+        self._offscreen_frame = None
 
-        x = 0
-        y = self._font.baseline
-        for c in message:
-            # support for '\n'
-            if c == "\n":
-                x = 0
-                y += (self._font.baseline + 1) # add an extra space so that the next line doesn't hug the baseline
-                continue
-            
-            x += self._font.DrawGlyph(self._offscreen_canvas, x, y, graphics.Color(color.R, color.G, color.B), ord(c))
+    @staticmethod
+    def default_font():
+        # loaded on first use rather than when the module is imported
+        if not LedDisplay._defaultFont:
+            LedDisplay._defaultFont = LedFont(LedDisplay.defaultFontFile)
+        return LedDisplay._defaultFont
 
-        self._offscreen_canvas = self._matrix.SwapOnVSync(self._offscreen_canvas)
+    def write(self, message, color=None):
+        frame = self._layout(message, color or LedDisplay.defaultColor)
+        if frame == self._displayed_frame:
+            return
+
+        if self._offscreen_frame is None:
+            self._offscreen_canvas.Clear()
+            self._offscreen_frame = {}
+
+        canvas = self._offscreen_canvas
+        changed = [cell for cell in (self._offscreen_frame.keys() | frame.keys()) if self._offscreen_frame.get(cell) is not frame.get(cell)]
+        # Erase all changed cells before drawing so that a glyph is never erased by its neighbour
+        for x,y in changed:
+            glyph = self._offscreen_frame.get((x, y))
+            if glyph:
+                for dx,dy,_,_,_ in glyph[1]:
+                    canvas.SetPixel(x + dx, y + dy, 0, 0, 0)
+        for x,y in changed:
+            glyph = frame.get((x, y))
+            if glyph:
+                for dx,dy,r,g,b in glyph[1]:
+                    canvas.SetPixel(x + dx, y + dy, r, g, b)
+
+        self._swap(frame)
 
     def clear(self):
         self._offscreen_canvas.Clear()
-        self._offscreen_canvas = self._matrix.SwapOnVSync(self._offscreen_canvas)
\ No newline at end of file
+        self._offscreen_frame = {}
+        self._swap({})
+
+    def _swap(self, frame):
+        self._offscreen_canvas = self._matrix.SwapOnVSync(self._offscreen_canvas)
+        # the canvas handed back is the one that was on display
+        self._offscreen_frame = self._displayed_frame
+        self._displayed_frame = frame
+
+    def _layout(self, message, color):
+        frame = {}
+        y = self._font.baseline
+        for line in message.split("\n"):
+            for x,glyph in self._layout_line(line, color):
+                frame[(x, y)] = glyph
+            y += (self._font.baseline + 1) # add an extra space so that the next line doesn't hug the baseline
+        return frame
+
+    def _layout_line(self, line, color):
+        key = (line, color.R, color.G, color.B)
+        cells = self._lines.get(key)
+        if cells is not None:
+            self._lines.move_to_end(key)
+            return cells
+
+        cells = []
+        x = 0
+        for c in line:
+            glyph = self._glyphs.get(self._font, c, color)
+            if glyph[1]:
+                cells.append((x, glyph))
+            x += glyph[0]
+        cells = tuple(cells)
+
+        self._lines[key] = cells
+        if len(self._lines) > LedDisplay.max_cached_lines:
+            self._lines.popitem(last=False)
+        return cells
\ No newline at end of file
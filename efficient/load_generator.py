@@ -0,0 +1,308 @@
+import argparse
+import json
+import platform
+import socket
+import struct
+import sys
+import time
+from datetime import datetime,timedelta
+from threading import Lock,Thread
+
+from binary_protocol import BinaryCommands,BinaryProtocol,ResponseCode
+from tracker_events import EpochTimes,EventTypes
+
+class RecordedEvent(object):
+    __slots__ = ('name', 'time_utc')
+
+    def __init__(self, name, time_utc):
+        self.name = name
+        self.time_utc = time_utc
+
+class Recordings(object):
+    '''
+    Reads event streams to replay, sorted by time. Journal exports are what `journalctl -o json` or
+    `journalctl -o export` print for the server's journal, e.g. `journalctl -o export EVENT_NAME=lunch_start + ...`;
+    entries without an EVENT_NAME are skipped.
+    '''
+
+    @staticmethod
+    def synthetic(event_count, seed):
+        from benchmark import SyntheticWorkday
+        workday = SyntheticWorkday(event_count, seed=seed)
+        return [RecordedEvent(EventTypes.name(type(e)), e.client_time_utc) for e in workday.events]
+
+    @staticmethod
+    def journal(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        first = data.lstrip()[:1]
+        entries = Recordings._json_entries(data) if first == b'{' else Recordings._export_entries(data)
+        events = [e for e in (Recordings._to_event(entry) for entry in entries) if e]
+        events.sort(key=lambda e: e.time_utc)
+        return events
+
+    @staticmethod
+    def _json_entries(data):
+        for line in data.splitlines():
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+    @staticmethod
+    def _export_entries(data):
+        '''
+        Parses the journal export format: `FIELD=value` lines, entries separated by an empty line, and binary fields
+        as the field name, a newline, a little-endian 64 bit size and the value.
+        '''
+
+        entry = {}
+        offset = 0
+        while offset < len(data):
+            end = data.find(b'\n', offset)
+            if end < 0:
+                end = len(data)
+            line = data[offset:end]
+            offset = end + 1
+
+            if not line:
+                if entry:
+                    yield entry
+                entry = {}
+                continue
+
+            name,separator,value = line.partition(b'=')
+            if not separator:
+                size, = struct.unpack_from('<Q', data, offset)
+                offset += 8
+                value = data[offset:offset + size]
+                offset += size + 1
+            entry[name.decode('utf-8')] = value.decode('utf-8', 'replace')
+
+        if entry:
+            yield entry
+
+    @staticmethod
+    def _to_event(entry):
+        name = entry.get('EVENT_NAME')
+        if not isinstance(name, str):
+            return None
+
+        client_time = entry.get('CLIENT_TIME_UTC')
+        if client_time:
+            return RecordedEvent(name, datetime.strptime(client_time, '%Y-%m-%dT%H:%M:%S.%f' if '.' in client_time else '%Y-%m-%dT%H:%M:%S'))
+        realtime = entry.get('__REALTIME_TIMESTAMP')
+        if realtime:
+            return RecordedEvent(name, EpochTimes.epoch + timedelta(microseconds=int(realtime)))
+        return None
+
+class LoadResults(object):
+    def __init__(self):
+        self._lock = Lock()
+        self.latencies = []
+        self.commands = 0
+        self.events = 0
+        self.errors = {}
+
+    def record(self, latency, event_count):
+        with self._lock:
+            self.latencies.append(latency)
+            self.commands += 1
+            self.events += event_count
+
+    def error(self, kind):
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed_seconds):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return (latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e3) if latencies else None
+
+        return {
+            'seconds': elapsed_seconds,
+            'commands': self.commands,
+            'events': self.events,
+            'commands_per_second': (self.commands / elapsed_seconds) if elapsed_seconds else None,
+            'events_per_second': (self.events / elapsed_seconds) if elapsed_seconds else None,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+            'max_ms': (latencies[-1] * 1e3) if latencies else None,
+            'errors': dict(self.errors),
+            'error_count': sum(self.errors.values()),
+        }
+
+class LoadClient(object):
+    '''
+    Replays `events` against a server as one user, in `events` commands of up to `batch_size` events. With a `speed`
+    the gaps between the recorded times are replayed compressed by that factor, otherwise commands are sent back to
+    back. Each command waits for its response, so latency is the round trip of one command. With `binary`, commands
+    are BinaryProtocol frames instead of JSON.
+    '''
+
+    def __init__(self, server_address, user, events, results, batch_size=1, speed=0, persistent=False, timeout_seconds=10, binary=False):
+        self._server_address = server_address
+        self._user = user
+        self._events = events
+        self._results = results
+        self._batch_size = batch_size
+        self._speed = speed
+        self._persistent = persistent
+        self._timeout_seconds = timeout_seconds
+        self._binary = binary
+
+        self._connection = None
+        self._responses = None
+
+    def run(self, started):
+        try:
+            first_time = self._events[0].time_utc if self._events else None
+            for i in range(0, len(self._events), self._batch_size):
+                batch = self._events[i:i + self._batch_size]
+                if self._speed:
+                    due = started + ((batch[0].time_utc - first_time).total_seconds() / self._speed)
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._send(batch)
+        finally:
+            self._disconnect()
+
+    def _send(self, batch):
+        if self._binary:
+            events = [(EventTypes.from_name(e.name), int(EpochTimes.to_epoch(e.time_utc) * 1000)) for e in batch]
+            message = BinaryProtocol.pack_request(BinaryCommands.id('events'), 0, self._user, BinaryProtocol.pack_events(events))
+        else:
+            command = {'command': 'events', 'user': self._user, 'args': {'events': [
+                {'name': e.name, 'time': EpochTimes.to_epoch(e.time_utc)} for e in batch]}}
+            message = json.dumps(command, separators=(',', ':')).encode('utf-8')
+
+        start = time.perf_counter()
+        try:
+            response = self._persistent_round_trip(message) if self._persistent else self._one_shot_round_trip(message)
+        except socket.timeout:
+            self._results.error('timeout')
+            self._disconnect()
+            return
+        except OSError as e:
+            self._results.error(type(e).__name__)
+            self._disconnect()
+            return
+        latency = time.perf_counter() - start
+
+        error = LoadClient._frame_error(response) if self._binary else LoadClient._response_error(response)
+        if error:
+            self._results.error(error)
+        else:
+            self._results.record(latency, len(batch))
+
+    def _one_shot_round_trip(self, message):
+        with socket.create_connection(self._server_address, timeout=self._timeout_seconds) as connection:
+            connection.sendall(message)
+            with connection.makefile('rb') as responses:
+                return self._read_response(responses)
+
+    def _persistent_round_trip(self, message):
+        if not self._connection:
+            self._connection = socket.create_connection(self._server_address, timeout=self._timeout_seconds)
+            self._responses = self._connection.makefile('rb')
+        self._connection.sendall(message if self._binary else (message + b'\n'))
+        response = self._read_response(self._responses)
+        if not response:
+            raise ConnectionResetError('Connection closed by the server')
+        return response
+
+    def _disconnect(self):
+        if self._connection:
+            self._responses.close()
+            self._connection.close()
+        self._connection = None
+        self._responses = None
+
+    def _read_response(self, responses):
+        if not self._binary:
+            return responses.readline()
+
+        header = responses.read(BinaryProtocol.header.size)
+        if len(header) < BinaryProtocol.header.size:
+            return b''
+        return header + responses.read(BinaryProtocol.payload_length(header))
+
+    @staticmethod
+    def _frame_error(response):
+        if not response:
+            return 'empty_response'
+        code,_,payload = BinaryProtocol.unpack_response(response)
+        if code != ResponseCode.Ok:
+            return 'rejected'
+        if 2 in BinaryProtocol.unpack_statuses(payload): # EventStatus.Invalid
+            return 'invalid_events'
+        return None
+
+    @staticmethod
+    def _response_error(response):
+        if not response:
+            return 'empty_response'
+        try:
+            data = json.loads(response.decode('utf-8'))
+        except ValueError:
+            return 'rejected'
+        if not isinstance(data, dict) or not isinstance(data.get('status'), list):
+            return 'rejected'
+        if 2 in data['status']: # EventStatus.Invalid
+            return 'invalid_events'
+        return None
+
+def run_load(server_address, events, concurrency, user_prefix, **client_options):
+    '''
+    Replays `events` once per client, `concurrency` clients at a time, each as its own user.
+    '''
+
+    results = LoadResults()
+    clients = [LoadClient(server_address, '{0}{1}'.format(user_prefix, i), events, results, **client_options) for i in range(concurrency)]
+
+    started = time.monotonic()
+    threads = [Thread(target=client.run, args=(started,), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.report(time.monotonic() - started)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays recorded or synthetic event streams against a running Efficient server and reports throughput and latency. Run the server with '--display null' to measure the protocol and tracking only")
+    parser.add_argument("--host", action="store", help="Server host. Default: 127.0.0.1", default='127.0.0.1', type=str)
+    parser.add_argument("--port", action="store", help="Server port. Default: 8080", default=8080, type=int)
+    parser.add_argument("--journal", action="store", help="Journal export to replay, from 'journalctl -o json' or 'journalctl -o export'. Default: a synthetic workday", default=None, type=str)
+    parser.add_argument("--events", action="store", help="Events in the synthetic workday. Default: 2000", default=2000, type=int)
+    parser.add_argument("--seed", action="store", help="Seed of the synthetic workday. Default: 0", default=0, type=int)
+    parser.add_argument("--speed", action="store", help="Time compression of the recorded gaps, e.g. 3600 replays an hour per second. 0 sends as fast as possible. Default: 0", default=0, type=float)
+    parser.add_argument("--concurrency", action="store", help="Clients replaying the stream at once, each as its own user. Default: 1", default=1, type=int)
+    parser.add_argument("--batch", action="store", help="Events per 'events' command. One-shot connections are read in a single 2048 byte receive, so keep batches small without --persistent-connections. Default: 1", default=1, type=int)
+    parser.add_argument("--persistent-connections", action="store_true", help="Send newline-delimited commands over one connection per client, for servers run with --persistent-connections", default=False)
+    parser.add_argument("--binary", action="store_true", help="Send binary protocol frames instead of JSON commands", default=False)
+    parser.add_argument("--user-prefix", action="store", help="Prefix of the client user ids. Default: load-", default='load-', type=str)
+    parser.add_argument("--timeout", action="store", help="Seconds to wait for a response. Default: 10", default=10, type=float)
+    parser.add_argument("-o", "--output", action="store", help="File to write the JSON report to. Default: stdout", default=None, type=str)
+    args = parser.parse_args()
+
+    events = Recordings.journal(args.journal) if args.journal else Recordings.synthetic(args.events, args.seed)
+    if not events:
+        print("No events to replay", file=sys.stderr)
+        sys.exit(1)
+
+    results = run_load((args.host, args.port), events, args.concurrency, args.user_prefix,
+        batch_size=args.batch, speed=args.speed, persistent=args.persistent_connections, timeout_seconds=args.timeout, binary=args.binary)
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'replayed_events': len(events),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,61 @@
+from threading import Lock
+
+from bdf_font import BdfFont
+from display import Display
+
+class MemoryDisplay(Display):
+    '''
+    Renders text into an in-memory RGB framebuffer the same way LedDisplay lays it out on the panel, e.g. to run the
+    server headless and inspect what the panel would show.
+    '''
+
+    defaultColor = (0, 255, 0)
+
+    def __init__(self, width, height, font_file):
+        self.width = width
+        self.height = height
+        self.message = None
+        self.writes = 0
+
+        self._font = BdfFont(font_file)
+        self._framebuffer = bytearray(width * height * 3)
+        self._lock = Lock()
+
+    def write(self, message, color=None):
+        rgb = (color.R, color.G, color.B) if color else MemoryDisplay.defaultColor
+        framebuffer = bytearray(self.width * self.height * 3)
+
+        y = self._font.baseline
+        for line in message.split("\n"):
+            x = 0
+            for c in line:
+                glyph = self._font.glyph(ord(c))
+                if glyph is None:
+                    continue
+                for dx,dy in glyph.pixels:
+                    self._set_pixel(framebuffer, x + dx, y + dy, rgb)
+                x += glyph.advance
+            y += (self._font.baseline + 1)
+
+        with self._lock:
+            self._framebuffer = framebuffer
+            self.message = message
+            self.writes += 1
+
+    def clear(self):
+        with self._lock:
+            self._framebuffer = bytearray(self.width * self.height * 3)
+            self.message = None
+
+    def framebuffer(self):
+        '''
+        Returns a copy of the frame as row-major RGB bytes.
+        '''
+
+        with self._lock:
+            return bytes(self._framebuffer)
+
+    def _set_pixel(self, framebuffer, x, y, rgb):
+        if (0 <= x < self.width) and (0 <= y < self.height):
+            offset = ((y * self.width) + x) * 3
+            framebuffer[offset:offset + 3] = bytes(rgb)
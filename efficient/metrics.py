@@ -0,0 +1,183 @@
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from threading import Lock
+from threading import Thread
+
+class Counter(object):
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        return self._value
+
+class Histogram(object):
+    '''
+    Latency histogram with fixed bucket upper bounds in seconds. Observing is a bisect and two additions.
+    '''
+
+    default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, name, help, labels, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._buckets = tuple(buckets)
+        # the last count is for observations above the largest bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(self._buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += seconds
+
+    def time(self):
+        return _Timing(self)
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        cumulative = []
+        running = 0
+        for bound,count in zip(self._buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {'count': running, 'sum': total, 'buckets': cumulative}
+
+class _Timing(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+class Metrics(object):
+    '''
+    Process-wide registry of counters and histograms. Metrics are created on first use and identified by name and labels.
+    '''
+
+    _metrics = {}
+    _lock = Lock()
+
+    @staticmethod
+    def counter(name, help='', **labels):
+        return Metrics._get(Counter, name, help, labels)
+
+    @staticmethod
+    def histogram(name, help='', **labels):
+        return Metrics._get(Histogram, name, help, labels)
+
+    @staticmethod
+    def snapshot():
+        '''
+        Returns {name: [{'labels': {...}, 'value': ...}]}, where the value of a histogram is its count, sum and
+        cumulative buckets.
+        '''
+
+        snapshot = {}
+        for metric in Metrics._all():
+            value = metric.snapshot()
+            if isinstance(metric, Histogram):
+                value = {'count': value['count'], 'sum': value['sum'], 'buckets': [[Metrics._format_bound(bound), count] for bound,count in value['buckets']]}
+            snapshot.setdefault(metric.name, []).append({'labels': metric.labels, 'value': value})
+        return snapshot
+
+    @staticmethod
+    def prometheus_text():
+        lines = []
+        described = set()
+        for metric in Metrics._all():
+            kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+                lines.append('# TYPE {0} {1}'.format(metric.name, kind))
+
+            if kind == 'counter':
+                lines.append('{0}{1} {2}'.format(metric.name, Metrics._format_labels(metric.labels), metric.snapshot()))
+                continue
+
+            value = metric.snapshot()
+            for bound,count in value['buckets']:
+                labels = dict(metric.labels, le=Metrics._format_bound(bound))
+                lines.append('{0}_bucket{1} {2}'.format(metric.name, Metrics._format_labels(labels), count))
+            lines.append('{0}_sum{1} {2}'.format(metric.name, Metrics._format_labels(metric.labels), value['sum']))
+            lines.append('{0}_count{1} {2}'.format(metric.name, Metrics._format_labels(metric.labels), value['count']))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _get(kind, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = Metrics._metrics.get(key)
+        if metric:
+            return metric
+
+        with Metrics._lock:
+            if key not in Metrics._metrics:
+                Metrics._metrics[key] = kind(name, help, labels)
+            return Metrics._metrics[key]
+
+    @staticmethod
+    def _all():
+        with Metrics._lock:
+            return sorted(Metrics._metrics.values(), key=lambda m: (m.name, sorted(m.labels.items())))
+
+    @staticmethod
+    def _format_bound(bound):
+        return '+Inf' if bound == float('inf') else repr(bound)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        escaped = ('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key,value in sorted(labels.items()))
+        return '{' + ','.join(escaped) + '}'
+
+class PrometheusExporter(object):
+    '''
+    Serves Metrics.prometheus_text() over HTTP on its own thread.
+    '''
+
+    def __init__(self, server_address):
+        self._server = HTTPServer(server_address, _PrometheusHandler)
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(name='prometheus_exporter', target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = Metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -1,180 +1,342 @@
 import argparse
+import asyncio
 import codecs
-import json
+import os
 import signal
 import sys
 
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime,timedelta
 from io import BytesIO
 from socketserver import TCPServer
 from socketserver import StreamRequestHandler
-
-from efficient import Efficient,EfficientException
+from syslog import LOG_DEBUG,LOG_ERR,LOG_INFO
+
+from binary_protocol import BinaryProtocol,BinaryProtocolException,ResponseCode
+from command_handler import CommandHandler
+from display import CompositeDisplay,NullDisplay
+from display_backends import DisplayBackends
+from efficient import Efficient
+from event_store import DayStore,EventStore,PersistentTracker
 from journald_logging import LogManager
-from led_display import LedDisplay
+from metrics import PrometheusExporter
+from runloop import SharedRunloop
+from sessions import EfficientSessions
+from subscriptions import Subscriptions
 from tracker import WorkDayTracker
 
 class EfficientHandler(StreamRequestHandler):
-    def __init__(self, efficient_tracker, request, client_address, server, max_data_length = 2048):
-        self._efficient = efficient_tracker
+    def __init__(self, command_handler, request, client_address, server, max_data_length = 2048):
+        self._commands = command_handler
         self._max_data_length = max_data_length
 
-        self._logger = LogManager.get_logger(__name__)
-
         super().__init__(request, client_address, server)
 
     def handle(self):
         message = self.request.recv(self._max_data_length)
-        self._logger.debug("Handling message '{0}'".format(message))
-
-        success,command,data = self._parse_command(message)
-        if not success:
-            self._logger.info("Message parsing failed with '{0}'".format(data))
-            self._send_message(data)
+        if BinaryProtocol.is_binary(message):
+            self._handle_frame(message)
             return
 
-        response = self._handle_command(command, data)
+        response = self._commands.handle_message(message)
         self._send_message(response)
 
-    def _handle_command(self, name, data):
-        self._logger.debug("Handling command '{0}'".format(name))
-        if name == "start":
-            return self._handle_start(data['args'])
-        elif name == "pause":
-            return self._handle_pause()
-        elif name == "resume":
-            return self._handle_resume()
-        elif name == "end":
-            return self._handle_end()
-        elif name == "event":
-            return self._handle_event(data['args'])
-
-        message = "Command '{0}' not supported".format(name) 
-        self._logger.info(message)
-        return message
-
-    def _handle_start(self, args):
-        '''
-        Wrapper around the start() method of Efficient.
-        Parses the arguments and calls the start() method
-        '''
+    def _handle_frame(self, data):
+        # unlike the JSON message, a frame says how long it is, so it is read in full
+        data = self._receive(data, BinaryProtocol.header.size)
+        if data is None:
+            return
+        try:
+            length = BinaryProtocol.payload_length(data)
+        except BinaryProtocolException as e:
+            self.wfile.write(BinaryProtocol.pack_response(ResponseCode.Malformed, 0, str(e).encode('utf-8')))
+            return
+        data = self._receive(data, BinaryProtocol.header.size + length)
+        if data is None:
+            return
 
-        if not args:
-            message = "Command 'start' does not have any arguments"
-            self._logger.debug(message)
-            return message
-        if 'duration' not in args:
-            message = "Command 'start' does not have any 'duration' specified"
-            self._logger.debug(message)
-            return message
+        self.wfile.write(self._commands.handle_frame(data))
 
-        duration = args['duration']
-        hours = duration['hours']
-        minutes = duration['minutes']
-        seconds = duration['seconds']
+    def _receive(self, data, size):
+        while (data is not None) and (len(data) < size):
+            chunk = self.request.recv(size - len(data))
+            data = (data + chunk) if chunk else None
+        return data
 
-        try:
-            self._efficient.start(timedelta(hours=hours, minutes=minutes, seconds=seconds), lambda: self._efficient.stop())
-        except EfficientException as e:
-            return str(e)
+    def _send_message(self, message, ending='\n'):
+        message_to_send = message + ending
+        message_bytes = message_to_send.encode('utf-8')
+        self.wfile.write(message_bytes)
 
-        response = "Timer started for hours:{0} minutes:{1} seconds:{2}".format(hours, minutes, seconds)
-        self._logger.info(response)
-        return response 
+class EfficientServer(TCPServer):
+    allow_reuse_address = True
 
-    def _handle_pause(self):
-        '''
-        Wrapper around the pause() method of Efficient.
-        Parses the arguments and calls the pause() method
-        '''
+    def __init__(self, server_address, RequestHandlerClass, command_handler):
+        self._command_handler = command_handler
 
-        try:
-            self._efficient.pause()
-        except EfficientException as e:
-            return str(e)
+        super().__init__(server_address, RequestHandlerClass)
 
-        response = "Timer paused"
-        self._logger.info(response)
-        return response 
+    def finish_request(self, request, client_address):
+        self.RequestHandlerClass(self._command_handler, request, client_address, self)
+
+class AsyncEfficientServer(object):
+    '''
+    Serves the command protocol over long-lived connections using asyncio.
+    Commands are newline-delimited JSON. Every command gets exactly one response line, in the order the commands were
+    received, so a client can pipeline any number of commands over one socket without waiting for each response.
+    Commands run on `command_lanes` worker threads, each of which runs the commands of the users hashed to it one at
+    a time, so the commands of a user run in the order they were received while a slow command of one user only holds
+    up the users sharing its lane. A slow client only ever waits on its own socket.
+    With `subscriptions`, a 'subscribe' command turns the connection into a stream: after the responses to the
+    commands before it, the connection gets one JSON line per tick of the user's session until it is closed, and
+    anything else the client sends is ignored.
+    A client that doesn't read what is written to it for `write_timeout_seconds`, or a subscriber dropped for reading
+    too slowly, has its connection aborted, which frees its slot of `max_connections`.
+    '''
+
+    def __init__(self, server_address, command_handler, max_line_length=2048, max_pending=32, idle_timeout_seconds=300, max_connections=64, subscriptions=None, max_buffered_ticks=8, write_timeout_seconds=30, command_lanes=8):
+        self._server_address = server_address
+        self._commands = command_handler
+        self._max_line_length = max_line_length
+        self._max_pending = max_pending
+        self._idle_timeout_seconds = idle_timeout_seconds
+        self._max_connections = max_connections
+        self._subscriptions = subscriptions
+        self._max_buffered_ticks = max_buffered_ticks
+        self._write_timeout_seconds = write_timeout_seconds
+
+        self._connections = 0
+        self._loop = None
+        self._server = None
+        self._lanes = tuple(ThreadPoolExecutor(max_workers=1, thread_name_prefix='commands-{0}'.format(lane)) for lane in range(command_lanes))
+        self._logger = LogManager.get_logger(__name__)
 
-    def _handle_resume(self):
-        '''
-        Wrapper around the resume() method of Efficient.
-        Parses the arguments and calls the resume() method
-        '''
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def server_close(self):
+        if self._loop and self._server:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        host,port = self._server_address
+        self._server = await asyncio.start_server(self._handle_connection, host or None, port, limit=self._max_line_length, reuse_address=True)
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        for lane in self._lanes:
+            lane.shutdown(wait=False)
+
+    async def _handle_connection(self, reader, writer):
+        if self._connections >= self._max_connections:
+            self._logger.info("Refusing connection. Already serving {0} connections", self._connections)
+            try:
+                await self._write_line(writer, "Too many connections")
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            writer.close()
+            return
 
+        self._connections += 1
+        # Responses are queued in command order. A full queue stops reading from the client, which bounds the work
+        # a single connection can have in flight.
+        pending = asyncio.Queue(maxsize=self._max_pending)
+        responder = asyncio.ensure_future(self._respond(pending, writer))
         try:
-            self._efficient.resume()
-        except EfficientException as e:
-            return str(e)
-
-        response = "Timer resumed"
-        self._logger.info(response)
-        return response 
+            subscribed_user = await self._read_commands(reader, pending)
+            await pending.put(None)
+            await responder
+            if subscribed_user is not None:
+                await self._stream(subscribed_user, reader, writer)
+        except asyncio.CancelledError:
+            # the server is shutting down
+            pass
+        finally:
+            responder.cancel()
+            writer.close()
+            self._connections -= 1
+
+    async def _read_commands(self, reader, pending):
+        # the first byte tells binary frames from JSON lines
+        try:
+            first = await asyncio.wait_for(reader.read(1), self._idle_timeout_seconds)
+        except (asyncio.TimeoutError, ConnectionError):
+            return
+        if BinaryProtocol.is_binary(first):
+            await self._read_frames(reader, pending, first)
+            return
 
-    def _handle_end(self):
+        prefix = first
+        while True:
+            try:
+                line = prefix + await asyncio.wait_for(reader.readline(), self._idle_timeout_seconds)
+                prefix = b''
+            except asyncio.TimeoutError:
+                return
+            except ValueError:
+                # the line is longer than the limit and the stream can't be resynchronized
+                await pending.put(AsyncEfficientServer._completed("Command longer than {0} bytes".format(self._max_line_length)))
+                return
+            except ConnectionError:
+                return
+
+            if not line:
+                return
+            if not line.strip():
+                continue
+
+            subscription = self._commands.subscription(line) if self._subscriptions else None
+            if subscription:
+                user,response = subscription
+                await pending.put(AsyncEfficientServer._completed(response))
+                if user is not None:
+                    return user
+                continue
+
+            await pending.put(self._run(self._commands.handle_message, line, "Command failed"))
+
+    async def _read_frames(self, reader, pending, first):
+        header_size = BinaryProtocol.header.size
+        prefix = first
+        while True:
+            try:
+                header = prefix + await asyncio.wait_for(reader.readexactly(header_size - len(prefix)), self._idle_timeout_seconds)
+                prefix = b''
+                length = BinaryProtocol.payload_length(header)
+                frame = header + await asyncio.wait_for(reader.readexactly(length), self._idle_timeout_seconds)
+            except BinaryProtocolException as e:
+                # a bad header can't be skipped, since its length can't be trusted
+                await pending.put(AsyncEfficientServer._completed(BinaryProtocol.pack_response(ResponseCode.Malformed, 0, str(e).encode('utf-8'))))
+                return
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+
+            _,_,_,request_id,_ = BinaryProtocol.header.unpack_from(header)
+            await pending.put(self._run(self._commands.handle_frame, frame, BinaryProtocol.pack_response(ResponseCode.Failed, request_id, b'Command failed')))
+
+    def _run(self, handle, message, failure):
         '''
-        Wrapper around the stop() method of Efficient.
-        Parses the arguments and calls the stop() method
+        Runs a command on the lane of its user. A command that raises is answered with `failure`, so that every
+        command still gets its response.
         '''
 
+        def run():
+            try:
+                return handle(message)
+            except Exception as e:
+                self._logger.error("Command failed with '{0}'", e)
+                return failure
+        lane = self._lanes[hash(self._commands.user_of(message)) % len(self._lanes)]
+        return self._loop.run_in_executor(lane, run)
+
+    async def _respond(self, pending, writer):
+        while True:
+            response = await pending.get()
+            if response is None:
+                return
+            if writer.is_closing():
+                # Keep draining so that the reader never blocks on a full queue
+                continue
+            try:
+                await self._write_line(writer, await response)
+            except asyncio.TimeoutError:
+                # the client stopped reading; later writes fail and are drained below
+                writer.transport.abort()
+            except ConnectionError:
+                # Keep draining so that the reader never blocks on a full queue
+                continue
+            except Exception as e:
+                # the responder must outlive any single response, or the connection stops answering for good
+                self._logger.error("Responding failed with '{0}'", e)
+
+    async def _stream(self, user, reader, writer):
+        publisher = self._subscriptions.publisher(user)
+        # a dropped subscriber may be stuck writing to a client that stopped reading; aborting frees it right away
+        subscriber = publisher.subscribe(self._loop, self._max_buffered_ticks, on_disconnect=writer.transport.abort)
+        closed = asyncio.ensure_future(AsyncEfficientServer._discard_input(reader))
         try:
-            self._efficient.stop()
-        except EfficientException as e:
-            return str(e)
-
-        response = "Timer ended"
-        self._logger.info(response)
-        return response 
-
-    def _handle_event(self, args):
-        if not args:
-            message = "Command 'event' does not have any arguments"
-            self._logger.debug(message)
-            return message
-
-        if 'name' not in args:
-            message = "Event does not have any 'name' specified"
-            self._logger.debug(message)
-            return message
-
-        name = args['name']
-        metadata = args['metadata'] if ('metadata' in args) else {}
-        self._logger.event(name, metadata)
-
-        return "Event '{0}' logged".format(name)
+            while True:
+                tick = asyncio.ensure_future(subscriber.next())
+                await asyncio.wait((tick, closed), return_when=asyncio.FIRST_COMPLETED)
+                if not tick.done():
+                    tick.cancel()
+                    return
+
+                line = tick.result()
+                if line is None:
+                    self._logger.info("Disconnecting slow subscriber of user '{0}'", user)
+                    return
+                await self._write_line(writer, line)
+        except asyncio.TimeoutError:
+            self._logger.info("Disconnecting subscriber of user '{0}' that stopped reading", user)
+            writer.transport.abort()
+        except ConnectionError:
+            return
+        finally:
+            publisher.unsubscribe(subscriber)
+            closed.cancel()
 
-    def _parse_command(self, message):
+    @staticmethod
+    async def _discard_input(reader):
         try:
-            str_message = message.decode('utf-8')
-            data = json.loads(str_message)
-        except json.JSONDecodeError as e:
-            return (False, None, "Malformed Json passed. {0}".format(str(e)))
-
-        if 'command' not in data:
-            return (False, None, "Json not of the correct type. Missing 'command' type")
-
-        return (True, data['command'], data)
-
-    def _send_message(self, message, ending='\n'):
-        message_to_send = message + ending
-        message_bytes = message_to_send.encode('utf-8')
-        self.wfile.write(message_bytes)
-
-class EfficientServer(TCPServer):
-    allow_reuse_address = True
-
-    def __init__(self, server_address, RequestHandlerClass, efficient_tracker):
-        self._efficient_tracker = efficient_tracker
-
-        super().__init__(server_address, RequestHandlerClass)
-
-    def finish_request(self, request, client_address):
-        self.RequestHandlerClass(self._efficient_tracker, request, client_address, self)
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    def _completed(message):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(message)
+        return future
+
+    async def _write_line(self, writer, message, ending='\n'):
+        # binary responses are complete frames
+        writer.write(message if isinstance(message, bytes) else (message + ending).encode('utf-8'))
+        await asyncio.wait_for(writer.drain(), self._write_timeout_seconds)
+
+def start_of_today_utc():
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return datetime.utcfromtimestamp(today.timestamp())
+
+def create_session(user_id):
+    '''
+    Creates the Efficient session of a user. The default user owns the LED display and the top level of the state dir.
+    '''
+
+    if args.state_dir:
+        state_dir = args.state_dir if (user_id == EfficientSessions.default_user) else os.path.join(args.state_dir, 'users', user_id)
+        tracker = WorkDayTracker(max_days=args.max_days, day_store=DayStore(os.path.join(state_dir, 'days')))
+        tracker = PersistentTracker(tracker, EventStore(state_dir))
+        tracker.load()
+    else:
+        tracker = WorkDayTracker(max_days=args.max_days)
+
+    session_display = display if (user_id == EfficientSessions.default_user) else NullDisplay()
+    session_display = CompositeDisplay((session_display, subscriptions.publisher(user_id)))
+    return Efficient(session_display, tracker, runloop_factory=runloop.create)
+
+def close_session(user_id, session):
+    '''
+    Persists the state of an evicted session. Its events are loaded back when the user comes back.
+    '''
+
+    if isinstance(session.tracker, PersistentTracker):
+        try:
+            session.tracker.close()
+        except OSError as e:
+            log.error("State of user '{0}' not saved. {1}", user_id, e)
 
 def terminate(signum, frame):
     if server:
         server.server_close()
+    for _,session in sessions.all():
+        if isinstance(session.tracker, PersistentTracker):
+            session.tracker.snapshot()
+    LogManager.stop_background()
     sys.exit(0)
 
 if __name__ == "__main__":
@@ -186,7 +348,25 @@ if __name__ == "__main__":
     # Server args
     parser.add_argument("--host", action="store", help="Host interface", default='', type=str)
     parser.add_argument("--port", action="store", help="Host port", default=8080, type=int)
+    parser.add_argument("--persistent-connections", action="store_true", help="Serve newline-delimited commands over long-lived, pipelined connections", default=False)
+    parser.add_argument("--max-connections", action="store", help="Persistent connections served at once. Default: 64", default=64, type=int)
+    parser.add_argument("--max-pending-commands", action="store", help="Pipelined commands in flight per persistent connection. Default: 32", default=32, type=int)
+    parser.add_argument("--idle-timeout", action="store", help="Seconds before an idle persistent connection is closed. Default: 300", default=300, type=int)
+    parser.add_argument("--write-timeout", action="store", help="Seconds a persistent connection may stop reading its responses or ticks before it is closed. Default: 30", default=30, type=int)
+    parser.add_argument("--command-lanes", action="store", help="Threads running the commands of persistent connections. The commands of a user always run on the same one, in order. Default: 8", default=8, type=int)
+    parser.add_argument("--max-sessions", action="store", help="Users served at once. Commands of further users are refused until idle sessions are evicted. Default: 1024", default=1024, type=int)
+    parser.add_argument("--session-idle-timeout", action="store", help="Seconds after which the session of a user without a running timer is evicted. Its events are kept in <state-dir>, and lost without a state dir. Default: 3600", default=3600, type=int)
+    parser.add_argument("--max-buffered-ticks", action="store", help="Ticks buffered per subscribed connection before the oldest are dropped. Default: 8", default=8, type=int)
+    parser.add_argument("--state-dir", action="store", help="Directory to persist tracked events in, so that a restart does not depend on the journal. Default: not persisted", default=None, type=str)
+    parser.add_argument("--max-days", action="store", help="Days of events kept in memory per user. Older days are moved to <state-dir>/days and loaded back when asked for, or dropped without a state dir; their range totals are kept either way. Default: 31", default=31, type=int)
+    parser.add_argument("--event-source", action="store", help="Where tracked events come from: journal reads them back from journald, commands tracks them as they are received, e.g. off the device. Default: commands with only the null and memory displays, journal otherwise", default=None, choices=['journal', 'commands'], type=str)
+    parser.add_argument("--journal-cursor-file", action="store", help="Resume tracked events from the journal position checkpointed in this file. Default: <state-dir>/journal.cursor, or replay today's events without a state dir", default=None, type=str)
+    parser.add_argument("--metrics-port", action="store", help="Local port to serve metrics in the Prometheus text format on. Default: not served", default=None, type=int)
+    parser.add_argument("--log-level", action="store", help="Lowest priority sent to journald. Default: info", default='info', choices=['debug', 'info', 'error'], type=str)
+    parser.add_argument("--log-queue-size", action="store", help="Log records queued for the background journald writer; 0 logs synchronously. Default: 4096", default=4096, type=int)
+    parser.add_argument("--log-block-when-full", action="store_true", help="Wait for room in a full log queue instead of dropping log messages. Events are never dropped", default=False)
     # Display args
+    parser.add_argument("--display", action="store", help="Display backend, one of {0}, or several separated by commas, e.g. led,console. led-process drives the LED panel from its own process. Default: led".format(', '.join(DisplayBackends.names())), default='led', type=str)
     parser.add_argument("-r", "--led-rows", action="store", help="Display rows. 16 for 16x32, 32 for 32x32. Default: 32", default=32, type=int)
     parser.add_argument("--led-cols", action="store", help="Panel columns. Typically 32 or 64. (Default: 32)", default=32, type=int)
     parser.add_argument("-c", "--led-chain", action="store", help="Daisy-chained boards. Default: 1.", default=1, type=int)
@@ -203,11 +383,39 @@ if __name__ == "__main__":
     parser.add_argument("--led-row-addr-type", action="store", help="0 = default; 1=AB-addressed panels", default=0, type=int, choices=[0,1])
     parser.add_argument("--led-multiplexing", action="store", help="Multiplexing type: 0=direct; 1=strip; 2=checker; 3=spiral (Default: 0)", default=0, type=int, choices=[0,1,2,3])
     args = parser.parse_args()
-
-    display = LedDisplay(args)
-    tracker = WorkDayTracker() # TODO: have to add the proper tracker
-    efficient = Efficient(display,tracker)
-    server = EfficientServer((args.host, args.port), EfficientHandler, efficient)
-    log.info("Efficient server started at port {0}".format(args.port))
+    for name in args.display.split(','):
+        if name.strip() not in DisplayBackends.names():
+            parser.error("argument --display: invalid choice: '{0}'".format(name))
+
+    LogManager.set_level({'debug': LOG_DEBUG, 'info': LOG_INFO, 'error': LOG_ERR}[args.log_level])
+    if args.log_queue_size > 0:
+        LogManager.start_background(queue_size=args.log_queue_size, block=args.log_block_when_full)
+
+    display = DisplayBackends.create(args.display, args)
+    runloop = SharedRunloop(delay=timedelta(seconds=1))
+    subscriptions = Subscriptions()
+    sessions = EfficientSessions(create_session, max_sessions=args.max_sessions, idle_seconds=args.session_idle_timeout, on_evicted=close_session)
+    tracker = sessions.get().tracker
+    event_source = args.event_source
+    if not event_source:
+        off_device = all(name.strip() in ('null', 'memory') for name in args.display.split(','))
+        event_source = 'commands' if off_device else 'journal'
+    if event_source == 'journal':
+        # only imported when used, so that the server runs without systemd off the device
+        from journald_event_listener import JournaldEventListener
+
+        cursor_file = args.journal_cursor_file
+        if args.state_dir:
+            cursor_file = cursor_file or os.path.join(args.state_dir, 'journal.cursor')
+        listener = JournaldEventListener(tracker, CommandHandler.__module__, cursor_file=cursor_file, since=start_of_today_utc(), tracker_for_user=lambda user_id: sessions.get(user_id).tracker, on_handled=lambda user_id: sessions.get(user_id).invalidate())
+        listener.start()
+    commands = CommandHandler(sessions, track_events=(event_source == 'commands'))
+    if args.persistent_connections:
+        server = AsyncEfficientServer((args.host, args.port), commands, max_pending=args.max_pending_commands, idle_timeout_seconds=args.idle_timeout, max_connections=args.max_connections, subscriptions=subscriptions, max_buffered_ticks=args.max_buffered_ticks, write_timeout_seconds=args.write_timeout, command_lanes=args.command_lanes)
+    else:
+        server = EfficientServer((args.host, args.port), EfficientHandler, commands)
+    if args.metrics_port:
+        PrometheusExporter(('127.0.0.1', args.metrics_port)).start()
+    log.info("Efficient server started at port {0}", args.port)
 
     server.serve_forever()
\ No newline at end of file
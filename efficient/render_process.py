@@ -0,0 +1,162 @@
+import atexit
+import os
+import signal
+from multiprocessing import get_context
+from multiprocessing import shared_memory
+from struct import Struct
+
+from display import Display
+
+class FrameRing(object):
+    '''
+    Ring of message slots in shared memory with one writing and one reading process. The writer never waits for the
+    reader: it fills the next slot and then publishes its sequence number. The reader only shows the latest published
+    slot. Each slot is stamped with its sequence before and after the payload, so a slot that the writer lapped
+    while it was being read is detected and skipped instead of shown torn.
+    '''
+
+    # published sequence
+    _header = Struct('<Q')
+    # sequence, flags, color, payload length
+    _slot_header = Struct('<QBBBBH2x')
+    # sequence again, written last
+    _slot_trailer = Struct('<Q')
+
+    Clear = 1
+    HasColor = 2
+
+    def __init__(self, memory, slot_count, capacity):
+        self._memory = memory
+        self._buffer = memory.buf
+        self._slot_count = slot_count
+        self._capacity = capacity
+        self._slot_size = FrameRing._slot_header.size + capacity + FrameRing._slot_trailer.size
+        self._sequence = FrameRing._header.unpack_from(self._buffer, 0)[0]
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    @staticmethod
+    def create(slot_count, capacity):
+        size = FrameRing._header.size + slot_count * (FrameRing._slot_header.size + capacity + FrameRing._slot_trailer.size)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        memory.buf[:size] = bytes(size)
+        return FrameRing(memory, slot_count, capacity)
+
+    @staticmethod
+    def attach(name, slot_count, capacity):
+        return FrameRing(shared_memory.SharedMemory(name=name), slot_count, capacity)
+
+    def write(self, message, color=None, flags=0):
+        payload = message.encode('utf-8')[:self._capacity]
+        if color is not None:
+            flags |= FrameRing.HasColor
+            r,g,b = color.R, color.G, color.B
+        else:
+            r,g,b = 0, 0, 0
+
+        sequence = self._sequence + 1
+        offset = self._slot_offset(sequence)
+        FrameRing._slot_header.pack_into(self._buffer, offset, sequence, flags, r, g, b, len(payload))
+        start = offset + FrameRing._slot_header.size
+        self._buffer[start:start + len(payload)] = payload
+        FrameRing._slot_trailer.pack_into(self._buffer, start + self._capacity, sequence)
+
+        FrameRing._header.pack_into(self._buffer, 0, sequence)
+        self._sequence = sequence
+
+    def read(self, after):
+        '''
+        Returns (sequence, flags, (r, g, b), message) of the latest slot when it is newer than `after`, or None when
+        there is nothing new or the slot was overwritten while it was read.
+        '''
+
+        sequence, = FrameRing._header.unpack_from(self._buffer, 0)
+        if sequence == after:
+            return None
+
+        # the reverse of the writer's order: a writer that laps the slot while it is copied has replaced the stamp by
+        # the time the stamp is read, even when it has not reached the trailer yet
+        offset = self._slot_offset(sequence)
+        start = offset + FrameRing._slot_header.size
+        trailer, = FrameRing._slot_trailer.unpack_from(self._buffer, start + self._capacity)
+        payload = bytes(self._buffer[start:start + self._capacity])
+        stamp,flags,r,g,b,length = FrameRing._slot_header.unpack_from(self._buffer, offset)
+        if (stamp != sequence) or (trailer != sequence):
+            return None
+
+        return (sequence, flags, (r, g, b), payload[:min(length, self._capacity)].decode('utf-8', 'ignore'))
+
+    def close(self, unlink=False):
+        self._buffer.release()
+        self._memory.close()
+        if unlink:
+            self._memory.unlink()
+
+    def _slot_offset(self, sequence):
+        return FrameRing._header.size + (sequence % self._slot_count) * self._slot_size
+
+class RenderProcessDisplay(Display):
+    '''
+    Runs a display backend (the LED panel by default) in a dedicated process. Writes only copy the message into a
+    FrameRing and wake the render process, so neither the GIL nor bursts of commands in the server process can stall
+    the panel refresh, and a slow panel never blocks the runloop. While nothing is written the render process sleeps,
+    waking every `liveness_seconds` only to check that the server process is still there.
+    '''
+
+    def __init__(self, backend, options, slot_count=4, capacity=1024, liveness_seconds=1.0):
+        self._ring = FrameRing.create(slot_count, capacity)
+        # spawned rather than forked: the server process already runs threads, and the panel library starts its own
+        context = get_context('spawn')
+        self._written = context.Event()
+        self._process = context.Process(name='efficient_render', target=_render,
+            args=(self._ring.name, slot_count, capacity, backend, options, self._written, liveness_seconds, os.getpid()))
+        self._process.daemon = True
+        self._process.start()
+        atexit.register(self.close)
+
+    def write(self, message, color=None):
+        self._ring.write(message, color)
+        self._written.set()
+
+    def clear(self):
+        self._ring.write('', flags=FrameRing.Clear)
+        self._written.set()
+
+    def close(self):
+        if not self._process:
+            return
+        self._process.terminate()
+        self._process.join()
+        self._process = None
+        self._ring.close(unlink=True)
+
+def _render(name, slot_count, capacity, backend, options, written, liveness_seconds, parent_pid):
+    # Ctrl+C reaches the whole process group; the server process decides when rendering stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from color import Color
+    from display_backends import DisplayBackends
+
+    ring = FrameRing.attach(name, slot_count, capacity)
+    display = DisplayBackends.create(backend, options)
+    sequence = 0
+    try:
+        while os.getppid() == parent_pid:
+            # cleared before reading, so a write during the read wakes the next wait instead of being missed
+            written.clear()
+            frame = ring.read(sequence)
+            if frame is None:
+                written.wait(liveness_seconds)
+                continue
+
+            sequence,flags,rgb,message = frame
+            if flags & FrameRing.Clear:
+                display.clear()
+            elif flags & FrameRing.HasColor:
+                display.write(message, Color(*rgb))
+            else:
+                display.write(message)
+    finally:
+        ring.close()
@@ -1,22 +1,78 @@
 import time
+from collections import deque
+from math import floor
+from threading import Event
+from threading import RLock
 from threading import Thread
+from threading import current_thread
+
+from metrics import Metrics
 
 class Runloop(object):
+    '''
+    Calls an action periodically on its own thread.
+    The first tick runs right away; the later ones are scheduled on absolute time.monotonic() deadlines `delay` apart
+    from the `phase` given to start(), e.g. the time a countdown started at, so they sample it right after each of its
+    seconds and the time the action takes does not push them back. An action that returns a deadline schedules its
+    own next tick instead. When the action overruns one or more deadlines, the missed ticks are skipped, counted and
+    reported to `on_overrun(missed_ticks, lateness_seconds)` instead of being run back to back.
+    `call_soon` runs one-off calls on the loop thread, and a suspended loop waits for those without ticking or waking
+    up on its own.
+    '''
+
     grace_timeout_seconds = 2
 
-    def __init__(self, delay):
+    _tick_seconds = Metrics.histogram('efficient_runloop_tick_seconds', 'Time taken by a runloop action')
+    _overruns = Metrics.counter('efficient_runloop_overruns_total', 'Runloop actions that ran past the next deadline')
+    _missed_ticks = Metrics.counter('efficient_runloop_missed_ticks_total', 'Runloop ticks skipped because of overruns')
+
+    def __init__(self, delay, on_overrun=None):
         self._delay = delay.total_seconds()
+        self._on_overrun = on_overrun
         self._loop = None
-        self._terminate = False
+        self._terminate = Event()
+        self._wake = Event()
+        self._calls = deque()
+        self._suspended = False
+        self._phase = None
+        self._restarted = False
+
+        self.overruns = 0
+        self.missed_ticks = 0
+        self.failed_calls = 0
+
+    def start(self, action, action_args, phase=None):
+        '''
+        Starts ticking on deadlines aligned to the time.monotonic() `phase`, by default the time of the call. Starting
+        a loop that runs already, e.g. to resume it, ticks right away and then on the new phase.
+        '''
 
-    def start(self, action, action_args):
+        self._phase = time.monotonic() if phase is None else phase
         if self._loop:
+            self._restarted = True
+            self._suspended = False
+            self._wake.set()
             return
 
         self._loop = Thread(name='runloop', target=self._run, args=(action, action_args))
         self._loop.daemon = True
         self._loop.start()
 
+    def suspend(self):
+        '''
+        Stops the ticks until the next start(), keeping the thread for `call_soon`.
+        '''
+
+        self._suspended = True
+
+    def call_soon(self, callback):
+        '''
+        Runs `callback` once on the loop thread, right away rather than at the next tick.
+        '''
+
+        self._calls.append(callback)
+        self._wake.set()
+
     def wait_until_stopped(self):
         self._loop.join()
 
@@ -24,16 +80,206 @@ class Runloop(object):
         if not self._loop:
             return
 
-        self._terminate = True
-        self._loop.join(Runloop.grace_timeout_seconds)
+        # wakes the loop right away instead of after the current delay
+        self._terminate.set()
+        self._wake.set()
+        # a call on the loop may stop it, e.g. when its timer elapsed; the loop then ends after that call
+        if current_thread() is not self._loop:
+            self._loop.join(Runloop.grace_timeout_seconds)
 
         self._reset()
 
     def _run(self, action, action_args):
-        while not self._terminate:
-            action(action_args)
-            time.sleep(self._delay)
+        # kept for this thread, since stopping replaces them for the next start
+        terminate,wake,calls = self._terminate, self._wake, self._calls
+        deadline = time.monotonic()
+        while not terminate.is_set():
+            wake.clear()
+            self._run_calls(calls)
+            if terminate.is_set():
+                return
+
+            if self._suspended:
+                wake.wait()
+                continue
+
+            now = time.monotonic()
+            if self._restarted:
+                self._restarted = False
+                deadline = now
+            if now >= deadline:
+                next_deadline = action(action_args)
+
+                finished = time.monotonic()
+                Runloop._tick_seconds.observe(finished - now)
+                if next_deadline is not None:
+                    deadline = next_deadline
+                else:
+                    deadline = self._next_deadline(self._phase, deadline, finished)
+                now = finished
+
+            wake.wait(max(deadline - now, 0))
+
+    def _next_deadline(self, phase, deadline, finished):
+        '''
+        Returns the deadline of the tick after the one due at `deadline` that finished at `finished`, reporting the
+        ticks it overran.
+        '''
+
+        next_deadline = Runloop._boundary_after(phase, self._delay, deadline)
+        if finished >= next_deadline:
+            self._overrun(finished, next_deadline)
+            next_deadline = Runloop._boundary_after(phase, self._delay, finished)
+        return next_deadline
+
+    @staticmethod
+    def _boundary_after(phase, delay, after):
+        boundary = phase + (floor((after - phase) / delay) + 1) * delay
+        # rounding may land on `after` itself
+        return boundary if (boundary > after) else (boundary + delay)
+
+    def _run_calls(self, calls):
+        while calls:
+            callback = calls.popleft()
+            try:
+                callback()
+            except Exception:
+                # a failing call must not stop the ticks
+                self.failed_calls += 1
+
+    def _overrun(self, now, deadline):
+        lateness = now - deadline
+        missed_ticks = int(lateness // self._delay) + 1
+
+        self.overruns += 1
+        self.missed_ticks += missed_ticks
+        Runloop._overruns.inc()
+        Runloop._missed_ticks.inc(missed_ticks)
+        if self._on_overrun:
+            self._on_overrun(missed_ticks, lateness)
 
     def _reset(self):
         self._loop = None
-        self._terminate = False
+        self._terminate = Event()
+        self._wake = Event()
+        self._calls = deque()
+        self._suspended = False
+        self._restarted = False
+
+class SharedRunloop(object):
+    '''
+    Drives the actions of any number of members from a single Runloop thread.
+    Each member has the start/stop/suspend/call_soon/wait_until_stopped interface of a Runloop, so it can be used in
+    place of one, and ticks on its own phase: the loop wakes up for the earliest deadline of its members and runs the
+    ones that are due. The loop thread runs only while there are members, and is suspended while all of them are.
+    '''
+
+    def __init__(self, delay, on_overrun=None):
+        self._delay = delay
+        self._on_overrun = on_overrun
+        self._runloop = None
+        self._lock = RLock()
+        # held for a whole tick, so that a stopped member is never called after stop() returns
+        self._tick_lock = RLock()
+        self._members = {}
+        self._suspended = set()
+        self._actions = ()
+        self._tick_thread = None
+
+        self.failed_actions = 0
+
+    def create(self):
+        return SharedRunloopMember(self)
+
+    def _add(self, member, action, action_args, phase):
+        with self._lock:
+            now = time.monotonic()
+            # due right away; the tick that runs it schedules the next one on its phase
+            self._members[member] = _MemberTicks(action, action_args, now if phase is None else phase, now)
+            self._suspended.discard(member)
+            self._update_actions()
+            if not self._runloop:
+                self._runloop = Runloop(self._delay, self._on_overrun)
+            self._runloop.start(action=self._tick, action_args=None)
+
+    def _suspend(self, member):
+        with self._lock:
+            if member in self._members:
+                self._suspended.add(member)
+                self._update_actions()
+
+    def _call_soon(self, callback):
+        with self._lock:
+            if self._runloop:
+                self._runloop.call_soon(callback)
+
+    def _remove(self, member):
+        with self._tick_lock, self._lock:
+            self._members.pop(member, None)
+            self._suspended.discard(member)
+            self._update_actions()
+            # the loop can't join itself; it is left idle when its last member stops from within a tick
+            if (not self._members) and self._runloop and (current_thread() is not self._tick_thread):
+                self._runloop.stop()
+                self._runloop = None
+
+    def _update_actions(self):
+        self._actions = tuple(ticks for member,ticks in self._members.items() if member not in self._suspended)
+        if (not self._actions) and self._runloop:
+            self._runloop.suspend()
+
+    def _tick(self, _):
+        '''
+        Runs the members that are due and returns the earliest deadline of the next ones.
+        '''
+
+        self._tick_thread = current_thread()
+        next_deadline = None
+        with self._tick_lock:
+            runloop = self._runloop
+            if not runloop:
+                # a tick that started while the last member stopped
+                return None
+            for ticks in self._actions:
+                if time.monotonic() >= ticks.deadline:
+                    try:
+                        ticks.action(ticks.action_args)
+                    except Exception:
+                        # one failing member must not stop the others
+                        self.failed_actions += 1
+                    ticks.deadline = runloop._next_deadline(ticks.phase, ticks.deadline, time.monotonic())
+                if (next_deadline is None) or (ticks.deadline < next_deadline):
+                    next_deadline = ticks.deadline
+        return next_deadline
+
+class _MemberTicks(object):
+    __slots__ = ('action', 'action_args', 'phase', 'deadline')
+
+    def __init__(self, action, action_args, phase, deadline):
+        self.action = action
+        self.action_args = action_args
+        self.phase = phase
+        self.deadline = deadline
+
+class SharedRunloopMember(object):
+    def __init__(self, shared_runloop):
+        self._shared_runloop = shared_runloop
+        self._stopped = Event()
+        self._stopped.set()
+
+    def start(self, action, action_args, phase=None):
+        self._stopped.clear()
+        self._shared_runloop._add(self, action, action_args, phase)
+
+    def suspend(self):
+        self._shared_runloop._suspend(self)
+
+    def call_soon(self, callback):
+        self._shared_runloop._call_soon(callback)
+
+    def wait_until_stopped(self):
+        self._stopped.wait()
+
+    def stop(self):
+        self._shared_runloop._remove(self)
+        self._stopped.set()
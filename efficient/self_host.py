@@ -25,6 +25,7 @@ if __name__ == '__main__':
     tracker.handle(bs)
 
     efficient = Efficient(display, tracker)
-    efficient.start(timedelta(hours=8, minutes=0, seconds=0), lambda: efficient.stop())
-    print('Runloop started')
+    # keep running past the end of the day so the display counts overtime up
+    efficient.start(timedelta(hours=8, minutes=0, seconds=0), None)
     efficient.wait_until_stopped()
+    display.clear()
@@ -0,0 +1,147 @@
+import re
+import time
+from threading import Event
+from threading import Lock
+from threading import RLock
+
+from efficient import EfficientException
+
+class EfficientSessions(object):
+    '''
+    Efficient instances per user, so one server can run the timers and trackers of many users.
+    Sessions are created on first use by `session_factory(user_id)`. The sessions are spread over `shards` maps with
+    a lock each; a lock is only held to look a session up or to reserve its place, and a session is built outside of
+    it, so building one, e.g. loading its state from disk, never holds up the other users of the shard. Every session
+    has its own lock after that, so commands of different users never wait on each other.
+    At most `max_sessions` sessions are kept. Sessions other than the default user's that were not used for
+    `idle_seconds` and have no timer running are evicted when a session is created, and `on_evicted(user_id, session)`
+    is called for them, e.g. to persist their state. A session that was evicted is created again when it is used.
+    '''
+
+    default_user = 'default'
+    _valid_user = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+    def __init__(self, session_factory, shards=16, max_sessions=None, idle_seconds=None, on_evicted=None):
+        self._session_factory = session_factory
+        self._shards = tuple(({}, RLock()) for _ in range(shards))
+        self._max_sessions = max_sessions
+        self._idle_seconds = idle_seconds
+        self._on_evicted = on_evicted
+
+        # sessions and places reserved for sessions being built, over all shards
+        self._count = 0
+        self._count_lock = Lock()
+        # user id -> time.monotonic() of the last use; assigned without a lock, an assignment is atomic
+        self._last_used = {}
+
+    def get(self, user_id=None):
+        user_id = EfficientSessions.default_user if user_id is None else user_id
+        if (not isinstance(user_id, str)) or (not EfficientSessions._valid_user.match(user_id)) or (user_id in ('.', '..')):
+            raise EfficientException("Invalid user '{0}'".format(user_id))
+
+        sessions,lock = self._shard(user_id)
+        session = sessions.get(user_id)
+        if isinstance(session, _PendingSession):
+            return session.wait()
+        if session:
+            self._last_used[user_id] = time.monotonic()
+            return session
+
+        # reserved before the shard is locked, since evicting locks every shard
+        self.evict_idle()
+        self._reserve()
+        with lock:
+            session = sessions.get(user_id)
+            if session is None:
+                pending = sessions[user_id] = _PendingSession()
+        if session is not None:
+            # created by another caller meanwhile
+            self._release()
+            return session.wait() if isinstance(session, _PendingSession) else session
+
+        try:
+            created = self._session_factory(user_id)
+        except BaseException as e:
+            with lock:
+                del sessions[user_id]
+            self._release()
+            pending.fail(e)
+            raise
+        self._last_used[user_id] = time.monotonic()
+        with lock:
+            sessions[user_id] = created
+        pending.done(created)
+        return created
+
+    def all(self):
+        sessions = []
+        for shard_sessions,lock in self._shards:
+            with lock:
+                sessions.extend((user_id, session) for user_id,session in shard_sessions.items() if not isinstance(session, _PendingSession))
+        return sessions
+
+    def evict_idle(self):
+        '''
+        Evicts the sessions that are idle, see the class documentation.
+        '''
+
+        if self._idle_seconds is None:
+            return
+
+        idle_since = time.monotonic() - self._idle_seconds
+        evicted = []
+        for sessions,lock in self._shards:
+            with lock:
+                for user_id,session in list(sessions.items()):
+                    if (user_id == EfficientSessions.default_user) or isinstance(session, _PendingSession):
+                        continue
+                    if (self._last_used.get(user_id, 0) > idle_since) or session.timer_started():
+                        continue
+                    del sessions[user_id]
+                    self._last_used.pop(user_id, None)
+                    evicted.append((user_id, session))
+        for user_id,session in evicted:
+            self._release()
+            if self._on_evicted:
+                self._on_evicted(user_id, session)
+
+    def _reserve(self):
+        if self._max_sessions is None:
+            return
+        with self._count_lock:
+            if self._count >= self._max_sessions:
+                raise EfficientException("Too many sessions. Serving {0} already".format(self._count))
+            self._count += 1
+
+    def _release(self):
+        if self._max_sessions is None:
+            return
+        with self._count_lock:
+            self._count -= 1
+
+    def _shard(self, user_id):
+        return self._shards[hash(user_id) % len(self._shards)]
+
+class _PendingSession(object):
+    '''
+    The place of a session that is being built, which the other callers for the same user wait on.
+    '''
+
+    def __init__(self):
+        self._built = Event()
+        self._session = None
+        self._error = None
+
+    def wait(self):
+        self._built.wait()
+        if self._error:
+            raise EfficientException("Session could not be created. {0}".format(self._error))
+        return self._session
+
+    def done(self, session):
+        self._session = session
+        self._built.set()
+
+    def fail(self, error):
+        self._error = error
+        self._built.set()
@@ -0,0 +1,147 @@
+import asyncio
+import json
+from threading import Lock
+
+from display import Display
+from metrics import Metrics
+from tracker_events import EventTypes
+
+class Subscriber(object):
+    '''
+    A connection streaming ticks. Ticks are buffered up to `max_buffered`; when the buffer is full the oldest tick is
+    dropped, since only the latest state matters. A subscriber that drops `max_buffered` ticks in a row is not reading
+    at all and is disconnected, and `on_disconnect` is called, e.g. to close its connection. Only used from the event
+    loop.
+    '''
+
+    _dropped = Metrics.counter('efficient_subscriber_dropped_ticks_total', 'Ticks dropped for subscribers that read too slowly')
+
+    def __init__(self, max_buffered, on_disconnect=None):
+        self._max_buffered = max_buffered
+        self._on_disconnect = on_disconnect
+        self._ticks = asyncio.Queue(maxsize=max_buffered)
+        self._dropped_in_row = 0
+        self.disconnected = False
+
+    def offer(self, line):
+        if self.disconnected:
+            return
+
+        if self._ticks.full():
+            self._ticks.get_nowait()
+            Subscriber._dropped.inc()
+            self._dropped_in_row += 1
+            if self._dropped_in_row >= self._max_buffered:
+                self.disconnect()
+                return
+        self._ticks.put_nowait(line)
+
+    async def next(self):
+        '''
+        Returns the next tick, or None once disconnected.
+        '''
+
+        line = await self._ticks.get()
+        self._dropped_in_row = 0
+        return line
+
+    def disconnect(self):
+        self.disconnected = True
+        while not self._ticks.empty():
+            self._ticks.get_nowait()
+        self._ticks.put_nowait(None)
+        if self._on_disconnect:
+            self._on_disconnect()
+
+class TickPublisher(Display):
+    '''
+    Display that streams the ticks of one session to its subscribers. A tick is encoded once and handed to the event
+    loop of the subscribers in one call, so the cost on the runloop does not depend on the number of subscribers; the
+    fan out to their buffers happens on the event loop. The last state is kept for new subscribers, which get it
+    right away instead of waiting for the display to change, e.g. while the timer is paused.
+    '''
+
+    _published = Metrics.counter('efficient_published_ticks_total', 'Ticks encoded for subscribers')
+
+    def __init__(self):
+        self._loop = None
+        self._subscribers = set()
+        # the last DisplayState, or the last message written; encoded only when someone subscribes
+        self._last = None
+
+    def subscribe(self, loop, max_buffered=8, on_disconnect=None):
+        '''
+        Adds a subscriber. Has to be called on `loop`, which is the loop all subscribers are served on.
+        '''
+
+        self._loop = loop
+        subscriber = Subscriber(max_buffered, on_disconnect)
+        self._subscribers.add(subscriber)
+        last = self._last
+        if last is not None:
+            subscriber.offer(TickPublisher._encode_last(last))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def update(self, state):
+        self._last = state
+        if not self._subscribers:
+            return
+
+        line = TickPublisher.encode(state)
+        TickPublisher._published.inc()
+        self._loop.call_soon_threadsafe(self._fan_out, line)
+
+    def write(self, message, color=None):
+        self._last = message
+        if self._subscribers:
+            self._loop.call_soon_threadsafe(self._fan_out, TickPublisher._encode_last(message))
+
+    def clear(self):
+        self._last = None
+
+    def _fan_out(self, line):
+        for subscriber in list(self._subscribers):
+            subscriber.offer(line)
+
+    @staticmethod
+    def encode(state):
+        '''
+        Encodes a DisplayState as one JSON line. Times are in seconds and ranges use the protocol names of their
+        events without the '_start' suffix, e.g. 'lunch'.
+        '''
+
+        return json.dumps({
+            'remaining': int(state.remaining.total_seconds()),
+            'overtime': int(state.overtime.total_seconds()),
+            'durations': [[TickPublisher._range_name(range_event), int(duration.total_seconds())] for range_event,duration in state.event_durations],
+            'message': state.message,
+        }, separators=(',', ':'))
+
+    @staticmethod
+    def _encode_last(last):
+        return json.dumps({'message': last}, separators=(',', ':')) if isinstance(last, str) else TickPublisher.encode(last)
+
+    @staticmethod
+    def _range_name(range_event):
+        name = EventTypes.name(range_event.start_event_type)
+        return name[:-len('_start')] if name.endswith('_start') else name
+
+class Subscriptions(object):
+    '''
+    The TickPublisher of every user, created on first use.
+    '''
+
+    def __init__(self):
+        self._publishers = {}
+        self._lock = Lock()
+
+    def publisher(self, user_id):
+        with self._lock:
+            publisher = self._publishers.get(user_id)
+            if publisher is None:
+                publisher = TickPublisher()
+                self._publishers[user_id] = publisher
+            return publisher
@@ -0,0 +1,108 @@
+import heapq
+import time
+from itertools import count
+from threading import Condition
+from threading import Thread
+
+from journald_logging import LogManager
+from metrics import Metrics
+
+class ScheduledCall(object):
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+class TimerScheduler(object):
+    '''
+    Runs the callbacks of any number of timers on one thread, ordered by a min-heap of time.monotonic() deadlines.
+    Scheduling is O(log n). Cancelling only marks the call; cancelled calls are dropped when they reach the top of the
+    heap, or all at once when they make up most of it. Callbacks should be short since they run one after another.
+    A callback that raises is logged and counted; the thread keeps running the others.
+    '''
+
+    _failures = Metrics.counter('efficient_timer_callback_failures_total', 'Scheduled timer callbacks that raised')
+
+    _shared = None
+    _shared_condition = Condition()
+
+    def __init__(self):
+        self._heap = []
+        self._cancelled = 0
+        self._sequence = count()
+        self._condition = Condition()
+        self._thread = None
+        self._logger = LogManager.get_logger(__name__)
+
+    @staticmethod
+    def shared():
+        '''
+        Returns the scheduler shared by all timers of the process.
+        '''
+
+        with TimerScheduler._shared_condition:
+            if not TimerScheduler._shared:
+                TimerScheduler._shared = TimerScheduler()
+            return TimerScheduler._shared
+
+    def schedule(self, delay_seconds, callback):
+        call = ScheduledCall(time.monotonic() + delay_seconds, callback)
+
+        with self._condition:
+            heapq.heappush(self._heap, (call.deadline, next(self._sequence), call))
+            if not self._thread:
+                self._thread = Thread(name='timer_scheduler', target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            # only an earlier first deadline changes how long the scheduler has to wait
+            if self._heap[0][2] is call:
+                self._condition.notify()
+
+        return call
+
+    def cancel(self, call):
+        with self._condition:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            self._cancelled += 1
+
+            if self._cancelled > (len(self._heap) // 2):
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _run(self):
+        while True:
+            with self._condition:
+                call = self._next_due()
+
+            try:
+                call.callback()
+            except Exception as e:
+                # one failing callback must not stop the timers of every other session
+                TimerScheduler._failures.inc()
+                self._logger.error("Timer callback failed with '{0}'", e)
+
+    def _next_due(self):
+        while True:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+
+            if not self._heap:
+                self._condition.wait()
+                continue
+
+            deadline,_,call = self._heap[0]
+            now = time.monotonic()
+            if deadline > now:
+                self._condition.wait(deadline - now)
+                continue
+
+            heapq.heappop(self._heap)
+            # a call that has run can no longer be cancelled
+            call.cancelled = True
+            return call
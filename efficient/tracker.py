@@ -1,11 +1,14 @@
 from abc import ABC
 from abc import abstractmethod
-from calendar import timegm
-from datetime import datetime
-from time import localtime
+from bisect import bisect_left,bisect_right
+from datetime import date,datetime,timedelta
+from heapq import merge
+from itertools import count,islice
+from math import floor
+from time import localtime,mktime
 from threading import RLock
 
-from tracker_events import WorkStartEvent,WorkEndEvent,LunchStartEvent,MiniBreakStartEvent
+from tracker_events import AutoExpiringRangeEvent,EpochTimes,RangeEvent,WorkStartEvent,WorkEndEvent,LunchStartEvent,LunchEndEvent,MiniBreakStartEvent,MiniBreakEndEvent
 
 class Tracker(ABC):
     @abstractmethod
@@ -16,20 +19,320 @@ class Tracker(ABC):
     def handle(self):
         raise NotImplementedError('abstract type')
 
+    def handle_many(self, events):
+        for event in events:
+            self.handle(event)
+
     @abstractmethod
-    def summarize(self, dt, aggregate):
+    def summarize(self, dt, aggregate=None):
+        '''
+        Summarizes the events of the day `dt` falls in. When `aggregate` is not given, the tracker's own running
+        range durations are returned.
+        '''
         raise NotImplementedError('abstract type')
 
+class RangeDurations(object):
+    '''
+    Running durations of range events, keyed by the base range event type (e.g. WorkEvent).
+    Events have to be added in client time order. A start event without a matching end event is kept open and is
+    counted as ongoing when the durations are read. An auto expiring range (lunch, mini breaks) that is still open at
+    its expiry ends there: it is closed when the next event of its type comes after the expiry, and counted up to the
+    expiry at most while it stays open. The durations only depend on the events, not on when they were added.
+    '''
+
+    def __init__(self, durations=None, open_events=None):
+        '''
+        `durations` of closed ranges and `open_events` restore previously saved state.
+        '''
+
+        self._durations = dict(durations or {})
+        self._open_events = {type(e): e for e in (open_events or ())}
+
+    @property
+    def closed_durations(self):
+        return self._durations
+
+    @property
+    def open_events(self):
+        return list(self._open_events.values())
+
+    def add(self, event):
+        if not isinstance(event, RangeEvent):
+            return
+
+        start_event_type = event.start_event_type
+        start_event = self._open_events.get(start_event_type)
+        if (start_event is not None) and issubclass(start_event_type, AutoExpiringRangeEvent) \
+                and (event.client_time_utc >= start_event.client_time_utc + start_event_type.expiry):
+            # the range ended at its expiry, before this event
+            del self._open_events[start_event_type]
+            self._add_duration(start_event_type, start_event_type.expiry)
+            start_event = None
+
+        if isinstance(event, start_event_type):
+            self._open_events[start_event_type] = event
+        elif (start_event is not None) and isinstance(event, event.end_event_type):
+            del self._open_events[start_event_type]
+            self._add_duration(start_event_type, event.client_time_utc - start_event.client_time_utc)
+
+    def copy(self):
+        return RangeDurations(self._durations, self._open_events.values())
+
+    def rebuild_range(self, range_event, events):
+        '''
+        Recomputes the durations of one range type (e.g. LunchEvent) from the sorted `events` of its type, e.g. after
+        a late event was inserted, which changes the pairing of the ranges of its type that follow it. Ranges of
+        different types never pair with each other, so the durations of the other types stay as they are.
+        '''
+
+        self._durations.pop(range_event, None)
+        self._open_events.pop(range_event.start_event_type, None)
+        for e in events:
+            self.add(e)
+
+    def at(self, now):
+        '''
+        Returns the durations with open ranges counted up to `now`, or up to their expiry for auto expiring ranges.
+        Costs O(number of range types).
+        '''
+
+        durations = dict(self._durations)
+        for start_event_type,start_event in self._open_events.items():
+            range_event = RangeDurations._base_range_event(start_event_type)
+            end = now
+            if issubclass(start_event_type, AutoExpiringRangeEvent):
+                end = min(now, start_event.client_time_utc + start_event_type.expiry)
+            durations[range_event] = durations.get(range_event, timedelta()) + (end - start_event.client_time_utc)
+        return durations
+
+    def _add_duration(self, start_event_type, duration):
+        range_event = RangeDurations._base_range_event(start_event_type)
+        self._durations[range_event] = self._durations.get(range_event, timedelta()) + duration
+
+    @staticmethod
+    def _base_range_event(event_type):
+        return event_type.__bases__[0]
+
+class EventsPrefix(object):
+    '''
+    Read-only sequence of the first `length` events of a list that is only appended to. Whoever changes the list
+    otherwise replaces it with a new one, so the prefix never changes and taking it costs nothing per event.
+    '''
+
+    __slots__ = ('_events', '_length')
+
+    def __init__(self, events, length):
+        self._events = events
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return islice(self._events, self._length)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._events[:self._length][index]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('event index out of range')
+        return self._events[index]
+
+class DaySnapshot(object):
+    '''
+    Immutable view of a day: its sorted events (a tuple or an EventsPrefix) and a copy of its range durations.
+    Nothing holding a snapshot changes it, so it can be read without a lock while the day it was taken from keeps
+    changing.
+    '''
+
+    __slots__ = ('events', 'durations')
+
+    def __init__(self, events, durations):
+        self.events = events
+        self.durations = durations
+
+    def __len__(self):
+        return len(self.events)
+
+class TrackedDays(object):
+    '''
+    Days of a WorkDayTracker: the snapshots of the days in memory, then the evicted days, each loaded from the
+    day store when iterated to, so persisting them does not bring them back into memory at once.
+    '''
+
+    def __init__(self, snapshots, stored_keys, day_store):
+        # (day ordinal, snapshot) pairs
+        self._snapshots = snapshots
+        self._stored_keys = stored_keys
+        self._day_store = day_store
+
+    def __len__(self):
+        return len(self._snapshots) + len(self._stored_keys)
+
+    def __iter__(self):
+        for _,snapshot in self.items():
+            yield snapshot
+
+    def items(self):
+        '''
+        Yields (day ordinal, snapshot) pairs.
+        '''
+
+        yield from self._snapshots
+        for key in self._stored_keys:
+            events,durations = self._day_store.load(key)
+            yield (key, DaySnapshot(tuple(events), durations))
+
+class WorkDay(object):
+    '''
+    Events of a single day kept sorted by client time, along with their running range durations.
+    `events` is only appended to in place and replaced when events are inserted, so snapshots can share it.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self.durations = RangeDurations()
+        self._times = [] # client times of `events`, kept for bisecting
+
+    def add(self, event):
+        time = event.client_time_utc
+        if (not self._times) or (time >= self._times[-1]):
+            self.events.append(event)
+            self._times.append(time)
+            self.durations.add(event)
+            return
+
+        index = bisect_right(self._times, time)
+        self.events = self.events[:index] + [event] + self.events[index:]
+        self._times.insert(index, time)
+        if isinstance(event, RangeEvent):
+            range_event = RangeDurations._base_range_event(event.start_event_type)
+            self.durations.rebuild_range(range_event, (e for e in self.events if isinstance(e, range_event)))
+
+    def add_many(self, events):
+        '''
+        Adds a batch of events in one pass. The batch is sorted (cheap when it is already presorted) and merged with the
+        existing events; ties keep the existing events first, the same as adding the events one at a time.
+        '''
+
+        events = sorted(events, key = lambda x: x.client_time_utc)
+        if not events:
+            return
+
+        if (not self._times) or (events[0].client_time_utc >= self._times[-1]):
+            self.events.extend(events)
+            self._times.extend(e.client_time_utc for e in events)
+            for e in events:
+                self.durations.add(e)
+            return
+
+        self.events = list(merge(self.events, events, key = lambda x: x.client_time_utc))
+        self._times = [e.client_time_utc for e in self.events]
+        self._rebuild_durations()
+
+    def restore(self, events, durations):
+        '''
+        Replaces the day with sorted `events` and their already computed `durations`.
+        '''
+
+        self.events = list(events)
+        self._times = [e.client_time_utc for e in self.events]
+        self.durations = durations
+
+    def snapshot(self):
+        return DaySnapshot(EventsPrefix(self.events, len(self.events)), self.durations.copy())
+
+    def _rebuild_durations(self):
+        self.durations = RangeDurations()
+        for e in self.events:
+            self.durations.add(e)
+
+class DayIndex(object):
+    '''
+    Maps UTC datetimes to the ordinal (`date.toordinal()`) of the local day they fall in.
+    The UTC boundaries of every local day looked up are cached, so consecutive lookups within the same day are a
+    subtraction and two comparisons.
+    '''
+
+    def __init__(self):
+        self._boundaries = {}
+        self._last = (0, 0, None)
+
+    def ordinal(self, utc):
+        epoch = EpochTimes.to_epoch(utc)
+        start,end,ordinal = self._last
+        if start <= epoch < end:
+            return ordinal
+
+        local_time = localtime(floor(epoch))
+        ordinal = date(local_time.tm_year, local_time.tm_mon, local_time.tm_mday).toordinal()
+        start,end = self.boundaries(ordinal)
+        self._last = (start, end, ordinal)
+        return ordinal
+
+    def boundaries(self, ordinal):
+        '''
+        Returns the UTC epoch seconds the local day starts at and the next local day starts at.
+        '''
+
+        boundaries = self._boundaries.get(ordinal)
+        if not boundaries:
+            boundaries = (DayIndex._local_midnight(ordinal), DayIndex._local_midnight(ordinal + 1))
+            self._boundaries[ordinal] = boundaries
+        return boundaries
+
+    @staticmethod
+    def _local_midnight(ordinal):
+        day = date.fromordinal(ordinal)
+        return mktime((day.year, day.month, day.day, 0, 0, 0, 0, 0, -1))
+
 class WorkDayTracker(Tracker):
+    '''
+    Tracks events per local day. Auto expiring ranges (lunch, mini breaks) that are not ended in time are ended at
+    their expiry by the days' RangeDurations, the same for live events and for replayed history.
+    Writers change the days under the lock and then publish a snapshot of every day they changed, by assigning it
+    to the day's key. Readers (the render loop, summaries and range queries) only read the published snapshots, so
+    they never wait for a write and never see a day in the middle of one.
+    With `max_days`, at most that many days are kept in memory. The least recently used days that are over are
+    evicted, to `day_store` when there is one (see DayStore), and only their range durations are kept for range
+    queries. An evicted day is reloaded from the store when it is summarized or written to again. Without a store,
+    the kept durations are what summaries return, and events that arrive late for the day add to them.
+    '''
+
     _handled_events = (
             WorkStartEvent,
             WorkEndEvent,
             LunchStartEvent,
-            MiniBreakStartEvent)
+            LunchEndEvent,
+            MiniBreakStartEvent,
+            MiniBreakEndEvent)
 
-    def __init__(self):
+    def __init__(self, day_factory=WorkDay, max_days=None, day_store=None):
         self._events = {}
+        self._snapshots = {}
         self._lock = RLock()
+        self._day_factory = day_factory
+        self._day_index = DayIndex()
+
+        self._max_days = max_days
+        self._day_store = day_store
+        # range durations of the evicted days, up to the end of the day
+        self._evicted = {}
+        # days changed since the last changed_days()
+        self._unsaved = set()
+        # day ordinal -> last use; assigned without the lock by readers, an assignment is atomic
+        self._last_used = {}
+        self._use_clock = count()
+
+        # Running totals of the closed range durations over the sorted days, for range queries. Entries from
+        # `_totals_stale_from` (a day ordinal) onwards are out of date and rebuilt by the next range query.
+        self._total_days = []
+        self._totals = []
+        self._totals_stale_from = None
+        # (days, totals) as published for readers, None while stale
+        self._published_totals = None
 
     def handled_events(self):
         return WorkDayTracker._handled_events
@@ -37,28 +340,236 @@ class WorkDayTracker(Tracker):
     def handle(self, event):
         assert(isinstance(event, WorkDayTracker._handled_events))
 
+        key = self._get_key(event.client_time_utc)
         with self._lock:
-            events = self._get_events_for_date(event.client_time_utc)
-            events.append(event)
-            events.sort(key = lambda  x: x.client_time_utc)
+            self._get_or_add_day(key).add(event)
+            self._changed(key)
+            self._evict(datetime.utcnow())
 
-    def summarize(self, dt, aggregate):
-        events = self._get_events_for_date(dt)
-        return aggregate(events)
+    def handle_many(self, events):
+        '''
+        Handles a batch of events, e.g. a replayed day of history. Events are grouped by day and each day is merged once.
+        '''
 
-    def _get_events_for_date(self, dt):
-        key = WorkDayTracker._get_key(dt)
-        if key not in self._events:
-            self._events[key] = []
-        return self._events[key]
+        days = {}
+        for event in events:
+            assert(isinstance(event, WorkDayTracker._handled_events))
+            days.setdefault(self._get_key(event.client_time_utc), []).append(event)
 
-    @staticmethod
-    def _get_key(dt):
-        local_time = WorkDayTracker._utc_to_local(dt)
-        return f"{local_time.tm_year}{local_time.tm_mon}{local_time.tm_mday}"
+        with self._lock:
+            for key,day_events in days.items():
+                self._get_or_add_day(key).add_many(day_events)
+                self._changed(key)
+            self._evict(datetime.utcnow())
 
-    @staticmethod
-    def _utc_to_local(utc):
-        # Idea is to convert the utc to epoch and reconvert the epoch to localtime
-        epoch = timegm(utc.timetuple())
-        return localtime(epoch)
\ No newline at end of file
+    def days(self):
+        '''
+        Returns snapshots of the tracked days, e.g. to persist them. Evicted days are loaded from the day store one
+        at a time while iterating.
+        '''
+
+        with self._lock:
+            stored = [key for key in self._evicted if key not in self._snapshots] if self._day_store else []
+            return TrackedDays(list(self._snapshots.items()), stored, self._day_store)
+
+    def changed_days(self):
+        '''
+        Returns the days changed since the last call, e.g. to persist only those. Like days(), evicted days are loaded
+        from the day store while iterating; the days evicted without a store have nothing left to return.
+        '''
+
+        with self._lock:
+            keys = sorted(self._unsaved)
+            self._unsaved = set()
+            snapshots = [(key, self._snapshots[key]) for key in keys if key in self._snapshots]
+            stored = [key for key in keys if (key not in self._snapshots) and (key in self._evicted)] if self._day_store else []
+            return TrackedDays(snapshots, stored, self._day_store)
+
+    def restore_day(self, events, durations):
+        '''
+        Restores a day from sorted `events` and their `durations`, replacing what is tracked for that day.
+        '''
+
+        if not events:
+            return
+
+        day = self._day_factory()
+        day.restore(events, durations)
+        key = self._get_key(events[0].client_time_utc)
+        with self._lock:
+            self._evicted.pop(key, None)
+            self._events[key] = day
+            # restored from where it was saved
+            self._publish(key)
+            self._unsaved.discard(key)
+            self._evict(datetime.utcnow())
+
+    def summarize(self, dt, aggregate=None):
+        now = datetime.utcnow()
+        key = self._get_key(dt)
+        day = self._snapshots.get(key)
+        if day is not None:
+            self._last_used[key] = next(self._use_clock)
+        elif key in self._evicted:
+            with self._lock:
+                if self._reload(key):
+                    self._evict(now, keep=key)
+                day = self._snapshots.get(key)
+        if aggregate:
+            return aggregate(day.events if day else [])
+        if day is None:
+            # evicted without a day store: only the day's durations are left
+            return dict(self._evicted.get(key, {}))
+        return day.durations.at(now)
+
+    def summarize_range(self, start, end):
+        '''
+        Returns the range durations of the local days from the one `start` falls in to the one `end` falls in, both
+        inclusive. Closed ranges come from running totals over the days. Ranges left open count up to the end of
+        their day, or up to now for today. Costs O(days in the range), independent of the number of events.
+        '''
+
+        first = self._get_key(start)
+        last = self._get_key(end)
+        now = datetime.utcnow()
+
+        totals = self._published_totals
+        if totals is None:
+            # only the first query after a write rebuilds the totals
+            with self._lock:
+                self._update_totals()
+                totals = self._published_totals
+
+        total_days,running_totals = totals
+        lo = bisect_left(total_days, first)
+        hi = bisect_right(total_days, last)
+        if lo >= hi:
+            return {}
+
+        durations = dict(running_totals[hi - 1])
+        if lo > 0:
+            for range_event,duration in running_totals[lo - 1].items():
+                durations[range_event] -= duration
+
+        for key in total_days[lo:hi]:
+            # an evicted day has its durations up to its end in the totals
+            day = self._snapshots.get(key)
+            if (day is None) or not day.durations.open_events:
+                continue
+            day_end = EpochTimes.from_epoch(self._day_index.boundaries(key)[1])
+            for range_event,duration in day.durations.at(min(now, day_end)).items():
+                ongoing = duration - day.durations.closed_durations.get(range_event, timedelta())
+                if ongoing > timedelta():
+                    durations[range_event] = durations.get(range_event, timedelta()) + ongoing
+
+        return {range_event: duration for range_event,duration in durations.items() if duration}
+
+    def _get_or_add_day(self, key):
+        day = self._events.get(key)
+        if (day is None) and self._reload(key):
+            day = self._events[key]
+        if day is None:
+            day = self._day_factory()
+            evicted = self._evicted.pop(key, None)
+            if evicted is not None:
+                # without a day store only the durations of an evicted day are left; later events add to them
+                day.restore((), RangeDurations(evicted))
+            self._events[key] = day
+        return day
+
+    def _reload(self, key):
+        '''
+        Loads an evicted day back into memory. Returns False when it was not evicted or is not in the day store.
+        '''
+
+        if (key not in self._evicted) or not self._day_store:
+            return False
+        stored = self._day_store.load(key)
+        if stored is None:
+            return False
+
+        day = self._day_factory()
+        day.restore(*stored)
+        del self._evicted[key]
+        self._events[key] = day
+        self._publish(key)
+        return True
+
+    def _evict(self, now, keep=None):
+        '''
+        Evicts the least recently used days while more than `max_days` are in memory. Only days that are over and
+        have no auto expiring range left to end are evicted, so nothing changes a day after it was evicted except a
+        late event, which reloads it.
+        '''
+
+        if (self._max_days is None) or (len(self._events) <= self._max_days):
+            return
+
+        epoch = EpochTimes.to_epoch(now)
+        candidates = sorted((key for key in self._events if (key != keep) and self._is_over(key, now, epoch)), key=lambda k: self._last_used.get(k, -1))
+        for key in candidates[:len(self._events) - self._max_days]:
+            snapshot = self._snapshots[key]
+            if self._day_store:
+                self._day_store.save(key, snapshot)
+
+            day_end = EpochTimes.from_epoch(self._day_index.boundaries(key)[1])
+            # published before the snapshot is removed, so readers always find the day in one of them
+            self._evicted[key] = snapshot.durations.at(day_end)
+            del self._snapshots[key]
+            del self._events[key]
+            self._last_used.pop(key, None)
+            # the totals move from closed durations to the durations at the end of the day
+            self._mark_totals_stale(key)
+
+    def _is_over(self, key, now, epoch):
+        if self._day_index.boundaries(key)[1] > epoch:
+            return False
+        return all((not isinstance(e, AutoExpiringRangeEvent)) or (e.client_time_utc + e.expiry <= now)
+            for e in self._snapshots[key].durations.open_events)
+
+    def _changed(self, key):
+        '''
+        Publishes the snapshot of a day that was written to, and remembers it for changed_days().
+        '''
+
+        self._publish(key)
+        self._unsaved.add(key)
+
+    def _publish(self, key):
+        '''
+        Publishes the snapshot of a day and marks the running totals from it on as stale.
+        '''
+
+        self._snapshots[key] = self._events[key].snapshot()
+        self._last_used[key] = next(self._use_clock)
+        self._mark_totals_stale(key)
+
+    def _mark_totals_stale(self, key):
+        self._published_totals = None
+        if (self._totals_stale_from is None) or (key < self._totals_stale_from):
+            self._totals_stale_from = key
+
+    def _update_totals(self):
+        if self._totals_stale_from is None:
+            if self._published_totals is None:
+                self._published_totals = (tuple(self._total_days), tuple(self._totals))
+            return
+
+        keep = bisect_left(self._total_days, self._totals_stale_from)
+        del self._total_days[keep:]
+        del self._totals[keep:]
+
+        running = dict(self._totals[-1]) if self._totals else {}
+        for key in sorted(k for k in (self._events.keys() | self._evicted.keys()) if k >= self._totals_stale_from):
+            evicted = self._evicted.get(key)
+            durations = evicted if evicted is not None else self._events[key].durations.closed_durations
+            for range_event,duration in durations.items():
+                running[range_event] = running.get(range_event, timedelta()) + duration
+            self._total_days.append(key)
+            self._totals.append(dict(running))
+
+        self._totals_stale_from = None
+        self._published_totals = (tuple(self._total_days), tuple(self._totals))
+
+    def _get_key(self, dt):
+        return self._day_index.ordinal(dt)
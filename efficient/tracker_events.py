@@ -1,54 +1,135 @@
-from datetime import timedelta
+from datetime import datetime,timedelta
+
+# Events are created per user action and kept for the whole day, so they are slotted to keep them small.
+# Values that are the same for every instance of an event type (range pairs, expiry) are class attributes.
 
 class Event(object):
+    __slots__ = ('name', 'client_time_utc', 'server_time_utc')
+
     def __init__(self, name, client_time_utc, server_time_utc):
         self.name = name
         self.client_time_utc = client_time_utc
         self.server_time_utc = server_time_utc
 
 class RangeEvent(Event):
-    def __init__(self, name, client_time_utc, server_time_utc, start_event_type, end_event_type):
-        super().__init__(name, client_time_utc, server_time_utc)
-        self.start_event_type = start_event_type
-        self.end_event_type = end_event_type
+    __slots__ = ()
+    start_event_type = None
+    end_event_type = None
 
 class AutoExpiringRangeEvent(RangeEvent):
-    def __init__(self, name, client_time_utc, server_time_utc, start_event_type, end_event_type, expiry):
-        super().__init__(name, client_time_utc, server_time_utc, start_event_type, end_event_type)
-        self.expiry = expiry
+    __slots__ = ()
+    expiry = None
 
 class WorkEvent(RangeEvent):
-    def __init__(self, name, client_time_utc, server_time_utc):
-        super().__init__(name, client_time_utc, server_time_utc, WorkStartEvent, WorkEndEvent)
+    __slots__ = ()
 
 class WorkStartEvent(WorkEvent):
+    __slots__ = ()
+
     def __init__(self, client_time_utc, server_time_utc):
         super().__init__("start", client_time_utc, server_time_utc)
 
 class WorkEndEvent(WorkEvent):
+    __slots__ = ()
+
     def __init__(self, client_time_utc, server_time_utc):
         super().__init__("end", client_time_utc, server_time_utc)
 
 class LunchEvent(AutoExpiringRangeEvent):
-    def __init__(self, name, client_time_utc, server_time_utc):
-        super().__init__(name, client_time_utc, server_time_utc, LunchStartEvent, LunchEndEvent, timedelta(minutes=45))
+    __slots__ = ()
+    expiry = timedelta(minutes=45)
 
 class LunchStartEvent(LunchEvent):
+    __slots__ = ()
+
     def __init__(self, client_time_utc, server_time_utc):
         super().__init__("start", client_time_utc, server_time_utc)
 
 class LunchEndEvent(LunchEvent):
+    __slots__ = ()
+
     def __init__(self, client_time_utc, server_time_utc):
         super().__init__("end", client_time_utc, server_time_utc)
 
 class MiniBreakEvent(AutoExpiringRangeEvent):
-    def __init__(self, name, client_time_utc, server_time_utc):
-        super().__init__(name, client_time_utc, server_time_utc, MiniBreakStartEvent, MiniBreakEndEvent, timedelta(minutes=15))
+    __slots__ = ()
+    expiry = timedelta(minutes=15)
 
 class MiniBreakStartEvent(MiniBreakEvent):
+    __slots__ = ()
+
     def __init__(self, client_time_utc, server_time_utc):
         super().__init__("start", client_time_utc, server_time_utc)
 
 class MiniBreakEndEvent(MiniBreakEvent):
+    __slots__ = ()
+
     def __init__(self, client_time_utc, server_time_utc):
-        super().__init__("end", client_time_utc, server_time_utc)
\ No newline at end of file
+        super().__init__("end", client_time_utc, server_time_utc)
+
+WorkEvent.start_event_type,WorkEvent.end_event_type = WorkStartEvent,WorkEndEvent
+LunchEvent.start_event_type,LunchEvent.end_event_type = LunchStartEvent,LunchEndEvent
+MiniBreakEvent.start_event_type,MiniBreakEvent.end_event_type = MiniBreakStartEvent,MiniBreakEndEvent
+
+class EventTypes(object):
+    '''
+    Small integer codes and protocol names for the concrete event types, used by compact event stores and clients.
+    Codes are persisted, so new types must be appended and existing codes never reused.
+    '''
+
+    _types = (
+            WorkStartEvent,
+            WorkEndEvent,
+            LunchStartEvent,
+            LunchEndEvent,
+            MiniBreakStartEvent,
+            MiniBreakEndEvent)
+    _names = (
+            'work_start',
+            'work_end',
+            'lunch_start',
+            'lunch_end',
+            'mini_break_start',
+            'mini_break_end')
+    _codes = {event_type: code for code,event_type in enumerate(_types, start=1)}
+    _types_by_name = dict(zip(_names, _types))
+
+    @staticmethod
+    def code(event_type):
+        return EventTypes._codes[event_type]
+
+    @staticmethod
+    def from_code(code):
+        return EventTypes._types[code - 1]
+
+    @staticmethod
+    def name(event_type):
+        return EventTypes._names[EventTypes._codes[event_type] - 1]
+
+    @staticmethod
+    def from_name(name):
+        '''
+        Returns the event type for a protocol name, or None when the name is not a typed event.
+        '''
+        return EventTypes._types_by_name.get(name)
+
+class EpochTimes(object):
+    '''
+    Converts UTC datetimes to and from seconds since the epoch, the float times that compact event stores and the
+    day index work with. A missing time is NaN.
+    '''
+
+    epoch = datetime(1970, 1, 1)
+    no_time = float('nan')
+
+    @staticmethod
+    def to_epoch(utc):
+        if utc is None:
+            return EpochTimes.no_time
+        return (utc - EpochTimes.epoch).total_seconds()
+
+    @staticmethod
+    def from_epoch(epoch):
+        if epoch != epoch: # nan
+            return None
+        return EpochTimes.epoch + timedelta(seconds=epoch)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of efficient import each other by name, the same as when network_host.py is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'efficient'))
@@ -0,0 +1,37 @@
+import json
+from datetime import datetime
+
+from command_handler import CommandHandler
+from display import NullDisplay
+from efficient import Efficient
+from sessions import EfficientSessions
+from tracker import WorkDayTracker
+from tracker_events import WorkEvent
+
+def create_handler(track_events):
+    sessions = EfficientSessions(lambda user_id: Efficient(NullDisplay(), WorkDayTracker()))
+    return CommandHandler(sessions, track_events=track_events),sessions
+
+def command(name, args, user=None):
+    return json.dumps({'command': name, 'user': user, 'args': args}).encode('utf-8')
+
+def test_event_is_tracked_when_tracking_commands():
+    handler,sessions = create_handler(track_events=True)
+
+    response = handler.handle_message(command('event', {'name': 'work_start'}, user='u1'))
+
+    assert response == "Event 'work_start' logged"
+    assert WorkEvent in sessions.get('u1').tracker.summarize(datetime.utcnow())
+
+def test_event_is_only_logged_when_tracking_the_journal():
+    handler,sessions = create_handler(track_events=False)
+
+    handler.handle_message(command('event', {'name': 'work_start'}, user='u1'))
+
+    assert WorkEvent not in sessions.get('u1').tracker.summarize(datetime.utcnow())
+
+def test_commands_for_a_timer_that_never_started_are_answered():
+    handler,_ = create_handler(track_events=True)
+
+    for name in ('end', 'pause', 'resume'):
+        assert handler.handle_message(command(name, None, user='u2')) == "Timer not started"
@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+from threading import Thread
+
+import pytest
+
+from display import NullDisplay
+from efficient import Efficient,EfficientException
+from sessions import EfficientSessions
+from tracker import WorkDayTracker
+
+def create_session(user_id):
+    return Efficient(NullDisplay(), WorkDayTracker())
+
+def test_sessions_over_the_limit_are_refused():
+    sessions = EfficientSessions(create_session, max_sessions=2)
+    sessions.get('u1')
+    sessions.get('u2')
+
+    with pytest.raises(EfficientException):
+        sessions.get('u3')
+    assert sessions.get('u1') is sessions.get('u1')
+
+def test_idle_sessions_are_evicted_for_new_ones():
+    evicted = []
+    sessions = EfficientSessions(create_session, max_sessions=2, idle_seconds=0, on_evicted=lambda user_id,session: evicted.append(user_id))
+    sessions.get('u1')
+    sessions.get('u2')
+
+    sessions.get('u3')
+
+    assert sorted(evicted) == ['u1', 'u2']
+    assert [user_id for user_id,_ in sessions.all()] == ['u3']
+
+def test_sessions_with_a_running_timer_are_not_evicted():
+    sessions = EfficientSessions(create_session, max_sessions=1, idle_seconds=0)
+    sessions.get('u1').start(timedelta(hours=1), None)
+    try:
+        with pytest.raises(EfficientException):
+            sessions.get('u2')
+    finally:
+        sessions.get('u1').stop()
+
+def test_a_session_is_built_once_and_without_holding_up_other_users():
+    built = []
+    def slow_session(user_id):
+        built.append(user_id)
+        if user_id == 'slow':
+            time.sleep(0.3)
+        return create_session(user_id)
+    sessions = EfficientSessions(slow_session, shards=1)
+
+    callers = [Thread(target=sessions.get, args=('slow',)) for _ in range(3)]
+    for caller in callers:
+        caller.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    sessions.get('fast')
+    assert time.monotonic() - start < 0.2
+    for caller in callers:
+        caller.join()
+
+    assert sorted(built) == ['fast', 'slow']